@@ -5,6 +5,7 @@ output is stored in a json file.
 """
 from argparse import ArgumentParser
 import json
+from multiprocessing import Pool
 import numpy as np
 import os
 from PIL import Image, ImageDraw
@@ -13,7 +14,8 @@ import sys
 from tqdm import tqdm
 
 from eval_constants import LOCALIZATION_TASKS
-from utils import encode_segmentation
+from segmentation_json import SegmentationWriter
+from utils import empty_segmentation, rle_counts_to_string
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -27,49 +29,278 @@ def create_mask(polygons, img_dims):
         polygons (list): [[[x11,y11],[x12,y12],...[x1n,y1n]],...]
 
     Returns:
-        mask (np.array): binary mask, 1 where the pixel is predicted to be the,
-						 pathology, 0 otherwise
+        mask (np.array): binary mask (uint8), 1 where the pixel is predicted to
+                         be the pathology, 0 otherwise
     """
-    poly = Image.new('1', (img_dims[1], img_dims[0]))
+    # an 8-bit image rasterizes exactly like a 1-bit one and converts to a
+    # uint8 array without unpacking bits
+    poly = Image.new('L', (img_dims[1], img_dims[0]))
+    draw = ImageDraw.Draw(poly)
     for polygon in polygons:
         coords = [(point[0], point[1]) for point in polygon]
-        ImageDraw.Draw(poly).polygon(coords,  outline=1, fill=1)
+        draw.polygon(coords,  outline=1, fill=1)
 
-    binary_mask = np.array(poly, dtype="int")
+    binary_mask = np.array(poly, dtype=np.uint8)
     return binary_mask
 
 
-def ann_to_mask(input_path, output_path):
+def _roundf(x):
+    """C `roundf`: round float32 values half away from zero."""
+    x = np.asarray(x, dtype=np.float64)
+    return np.copysign(np.floor(np.abs(x) + 0.5), x).astype(np.float32)
+
+
+def _round_up(xx):
+    """PIL's ROUND_UP of float32 span starts (`f + 0.5F` is float32)."""
+    return np.where(xx >= 0, np.floor(xx + np.float32(0.5)),
+                    -np.floor(np.abs(xx.astype(np.float64)) + 0.5))
+
+
+def _round_down(xx):
+    """PIL's ROUND_DOWN of float32 span ends."""
+    return np.where(xx >= 0, np.ceil(xx - np.float32(0.5)),
+                    -np.ceil(np.abs(xx.astype(np.float64)) - 0.5))
+
+
+def _polygon_edges(polygon):
     """
+    Build the edge list of a polygon like PIL's `ImagingDrawPolygon`:
+    coordinates are truncated to ints, consecutive horizontal edges going the
+    same way are merged and the polygon is closed.
+
+    Returns:
+        edges (list): (x0, y0, xmin, xmax, ymin, ymax, dx) per edge, with dx
+                      the float32 change of x per row
+    """
+    xy = [(int(point[0]), int(point[1])) for point in polygon]
+    edges = []
+
+    def add_edge(x0, y0, x1, y1):
+        if y0 == y1:
+            dx = np.float32(0)
+        else:
+            dx = np.float32(x1 - x0) / np.float32(y1 - y0)
+        edges.append([x0, y0, min(x0, x1), max(x0, x1), min(y0, y1),
+                      max(y0, y1), dx])
+
+    for i in range(len(xy) - 1):
+        (x0, y0), (x1, y1) = xy[i], xy[i + 1]
+        if y0 == y1 and i != 0 and y0 == xy[i - 1][1]:
+            # a horizontal edge following another horizontal edge
+            if x1 > x0 > xy[i - 1][0]:
+                edges[-1][3] = x1
+                continue
+            elif x1 < x0 < xy[i - 1][0]:
+                edges[-1][2] = x1
+                continue
+        add_edge(x0, y0, x1, y1)
+    if len(xy) > 1 and xy[-1] != xy[0]:
+        add_edge(*xy[-1], *xy[0])
+    return edges
+
+
+def _polygon_spans(polygon, height):
+    """
+    Scanline fill of a polygon following PIL's `polygon_generic`, with the
+    crossings of the edges and the rows computed in float32 like PIL does.
+
+    Args:
+        polygon (list): [[x1,y1],[x2,y2],...[xn,yn]]
+        height (int): number of rows of the mask
+
+    Returns:
+        spans (np.array): (row, first column, last column) of each filled
+                          span, not clipped to the mask
+    """
+    edges = _polygon_edges(polygon)
+    if not edges:
+        return np.zeros((0, 3), dtype=np.int64)
+    ymin = max(min(min(e[4] for e in edges), height - 1), 0)
+    ymax = min(max(max(e[5] for e in edges), 0), height)
+
+    # horizontal edges are drawn as they are
+    spans = [np.array([[e[4], e[2], e[3]] for e in edges if e[4] == e[5]],
+                      dtype=np.int64).reshape(-1, 3)]
+    table = [e for e in edges if e[4] != e[5]]
+
+    def crossing(edge, y):
+        x0, y0, dx = edge[0], edge[1], edge[6]
+        return np.float32(y - y0) * dx + np.float32(x0)
+
+    rows, xx = [], []
+    for i, current in enumerate(table):
+        x0, y0, _, _, e_ymin, e_ymax, dx = current
+        y = np.arange(max(e_ymin, ymin), min(e_ymax, ymax) + 1)
+        if not len(y):
+            continue
+        x = (y - y0).astype(np.float32) * dx + np.float32(x0)
+        if e_ymax < ymax:
+            # the last row of an edge counts twice
+            y = np.append(y, e_ymax)
+            x = np.append(x, x[-1])
+        elif y[-1] == e_ymax:
+            # connect discontiguous corners on the last row
+            x = _fix_corner(x, -1, e_ymax, current, table[:i], crossing)
+        if y[0] == e_ymin:
+            x = _fix_corner(x, 0, e_ymin, current, table[:i], crossing)
+        rows.append(y)
+        xx.append(x)
+    if not rows:
+        return spans[0]
+
+    # fill between consecutive crossings of each row
+    rows, xx = np.concatenate(rows), np.concatenate(xx)
+    order = np.lexsort((xx, rows))
+    rows, xx = rows[order], xx[order]
+    first = np.searchsorted(rows, rows)
+    ends = np.flatnonzero((np.arange(len(rows)) - first) % 2 == 1)
+    spans.append(np.stack([rows[ends], _round_up(xx[ends - 1]),
+                           _round_down(xx[ends])], axis=1).astype(np.int64))
+    return np.concatenate(spans)
+
+
+def _fix_corner(x, index, y, current, others, crossing):
+    """
+    PIL's "connect discontiguous corners" adjustment of the crossing
+    `x[index]` of `current` with row `y`, where the edge starts or ends.
+    """
+    if current[6] == 0:
+        return x
+    for other in others:
+        if (y != other[4] and y != other[5]) or other[6] == 0:
+            continue
+        if _roundf(x[index]) != _roundf(crossing(other, y)):
+            continue
+        offset = -1 if y == current[5] else 1
+        if not other[4] <= y + offset <= other[5]:
+            continue
+        adjacent = crossing(current, y + offset)
+        adjacent_other = crossing(other, y + offset)
+        if (x[index] > adjacent + np.float32(1)
+                and x[index] > adjacent_other + np.float32(1)):
+            x[index] = _roundf(max(adjacent, adjacent_other)) + np.float32(1)
+        elif (x[index] < adjacent - np.float32(1)
+                and x[index] < adjacent_other - np.float32(1)):
+            x[index] = _roundf(min(adjacent, adjacent_other)) - np.float32(1)
+        break
+    return x
+
+
+def polygons_to_rle(polygons, img_dims):
+    """
+    Encode the mask `create_mask` would draw for `polygons` without
+    rasterizing it: the filled spans of every row are turned into the
+    column-major runs of the Mask API.
+
+    Args:
+        polygons (list): [[[x11,y11],[x12,y12],...[x1n,y1n]],...]
+        img_dims (list): [height, width] of the mask
+
+    Returns:
+        rle (dict): encoded mask with str counts
+    """
+    height, width = int(img_dims[0]), int(img_dims[1])
+    spans = np.concatenate([_polygon_spans(polygon, height)
+                            for polygon in polygons]).reshape(-1, 3)
+    # clip the spans like PIL's hline
+    rows, starts, stops = spans[:, 0], np.maximum(spans[:, 1], 0), \
+        np.minimum(spans[:, 2], width - 1) + 1
+    keep = (rows >= 0) & (rows < height) & (starts < stops)
+    rows, starts, stops = rows[keep], starts[keep], stops[keep]
+
+    # union of the spans of each row, as half-open [start, stop) intervals
+    # of a row-major index with a gap of one column between rows
+    starts = rows * (width + 1) + starts
+    stops = rows * (width + 1) + stops
+    order = np.argsort(starts, kind='stable')
+    starts, stops = starts[order], stops[order]
+    reach = np.maximum.accumulate(stops) if len(stops) else stops
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > reach[:-1]
+    starts = starts[new]
+    stops = np.append(reach[np.flatnonzero(new)[1:] - 1], reach[-1:])
+
+    # a column changes value at a row where the boundaries of that row and
+    # the previous one differ
+    bounds = np.concatenate([starts, stops])
+    bounds = np.concatenate([bounds, bounds + width + 1])
+    bounds, counts = np.unique(bounds, return_counts=True)
+    bounds = bounds[counts % 2 == 1]
+    row = bounds[::2] // (width + 1)
+    first = bounds[::2] - row * (width + 1)
+    last = bounds[1::2] - row * (width + 1)
+
+    # every changed pixel is the start of a run in column-major order; a
+    # column ending in the mask and the next one starting in it cancel out
+    lengths = last - first
+    columns = np.repeat(first - np.cumsum(lengths) + lengths, lengths) \
+        + np.arange(lengths.sum())
+    changes = columns * height + np.repeat(row, lengths)
+    changes, counts = np.unique(changes, return_counts=True)
+    changes = changes[counts % 2 == 1]
+
+    runs = np.diff(np.concatenate([[0], changes, [height * width]]))
+    if len(runs) > 1 and runs[-1] == 0:
+        runs = runs[:-1]
+    return {'size': [height, width], 'counts': rle_counts_to_string(runs)}
+
+
+def _encode_annotation(job):
+    """Encode the segmentations of every task of one CXR."""
+    img_id, cxr_ann = job
+    img_dims = cxr_ann['img_size']
+    encoded = []
+    for task in LOCALIZATION_TASKS:
+        polygons = cxr_ann[task] if task in cxr_ann else []
+        if not polygons:
+            # no annotation: skip rasterizing an all-zero mask
+            encoded_map = empty_segmentation(*img_dims)
+        else:
+            # encode the runs of the segmentation without drawing it
+            encoded_map = polygons_to_rle(polygons, img_dims)
+        encoded.append((task, encoded_map))
+    return img_id, encoded
+
+
+def ann_to_mask(input_path, output_path, workers=1, chunksize=16):
+    """
+    With `workers` > 1, CXRs are sharded across a process pool in chunks of
+    `chunksize`. Workers return RLE dicts which are written in the order of
+    the annotation file, so the output is the same as with a single process.
+
     Args:
         input_path (string): json file path with raw human annotations
         output_path (string): json file path for saving encoded segmentations
+        workers (int): number of processes used to create segmentations
+        chunksize (int): number of CXRs sent to a worker at a time
     """
     print(f"Reading annotations from {input_path}...")
     with open(input_path) as f:
         ann = json.load(f)
 
+    jobs = ann.items()
+    if workers > 1:
+        pool = Pool(workers)
+        encoded = pool.imap(_encode_annotation, jobs, chunksize=chunksize)
+    else:
+        pool = None
+        encoded = map(_encode_annotation, jobs)
+
+    # encoded segmentations are written to the json file as they are created
     print(f"Creating and encoding segmentations...")
-    results = {}
-    for img_id in tqdm(ann.keys()):
-        if img_id not in results:
-            results[img_id] = {}
-        for task in LOCALIZATION_TASKS:
-            # create segmentation
-            polygons = ann[img_id][task] if task in ann[img_id] else []
-            img_dims = ann[img_id]['img_size']
-            segm_map = create_mask(polygons, img_dims)
-
-            # encode to coco mask
-            encoded_map = encode_segmentation(segm_map)
-            results[img_id][task] = encoded_map
-
-    assert len(results.keys()) == len(ann.keys())
-
-    # save segmentations to json file
+    try:
+        with SegmentationWriter(output_path) as writer:
+            for img_id, cxr_encoded in tqdm(encoded, total=len(ann)):
+                for task, encoded_map in cxr_encoded:
+                    writer.write(img_id, task, encoded_map)
+
+            # checked before the writer moves the file to output_path
+            assert len(writer) == len(ann.keys())
+    finally:
+        if pool is not None:
+            pool.terminate()
+
     print(f"Segmentation masks saved to {output_path}")
-    with open(output_path, "w") as outfile:
-        json.dump(results, outfile)
 
 
 if __name__ == "__main__":
@@ -79,6 +310,9 @@ if __name__ == "__main__":
     parser.add_argument('--output_path', type=str,
                         default='./human_segmentations.json',
                         help='json file path for saving encoded segmentations')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used to create segmentations; \
+                              1 creates them in the main process')
     args = parser.parse_args()
 
-    ann_to_mask(args.ann_path, args.output_path)
+    ann_to_mask(args.ann_path, args.output_path, args.workers)
@@ -13,6 +13,8 @@ import pickle
 from pycocotools import mask
 
 from eval_constants import LOCALIZATION_TASKS
+from segmentation_json import iter_segmentations
+from utils import rle_is_empty
 
 
 def get_geometric_features(segm):
@@ -48,41 +50,64 @@ def get_geometric_features(segm):
 
 def main(args):
     # load ground-truth annotations (needed to extract number of instances)
-    # and ground-truth segmentations
     with open(args.gt_ann) as f:
         gt_ann = json.load(f)
-    with open(args.gt_seg) as f:
-        gt_seg = json.load(f)
 
+    # calculate features for cxrs with a pathology segmentation, reading the
+    # ground-truth segmentations one at a time
+    tasks = sorted(LOCALIZATION_TASKS)
+    features = {}
+    for img_id, task, gt_item in iter_segmentations(args.gt_seg):
+        if img_id not in gt_ann or task not in tasks:
+            continue
+        # only decode segmentations that have a pathology
+        if not rle_is_empty(gt_item):
+            gt_mask = mask.decode(gt_item)
+            features[(img_id, task)] = get_features(gt_ann, img_id, task,
+                                                    gt_mask)
+
+    save_features(features, sorted(gt_ann.keys()), args.save_dir)
+
+
+def get_features(gt_ann, img_id, task, gt_mask):
+    """
+    Return the number of instances, area ratio, elongation and rectangular
+    area ratio of a non-empty ground-truth segmentation.
+    """
+    # use annotation to get number of instances
+    n_instance = len(gt_ann[img_id][task]) \
+            if task in gt_ann[img_id] else 0
+    # use segmentation to get other features
+    n_instance_segm, area, elongation, rec_area_ratio = \
+            get_geometric_features(gt_mask)
+    return n_instance, area, elongation, rec_area_ratio
+
+
+def save_features(features, all_ids, save_dir):
+    """
+    Save one csv per feature, with a row for every CXR in `all_ids`.
+
+    Args:
+        features (dict): {(img_id, task): features} of the CXRs with a
+                         pathology segmentation (see `get_features`)
+        all_ids (list): sorted ids of all CXRs
+        save_dir (str): where to save feature dataframes
+    """
     # extract features from all cxrs with at least one pathology
+    tasks = sorted(LOCALIZATION_TASKS)
     all_instances = {}
     all_areas = {}
     all_elongations = {}
     all_rec_area_ratios = {}
-    all_ids = sorted(gt_ann.keys())
-    pos_ids = sorted(gt_seg.keys())
-    for task in sorted(LOCALIZATION_TASKS):
+    for task in tasks:
         print(task)
         n_instances = []
         areas = []
         elongations = []
         rec_area_ratios = []
         for img_id in all_ids:
-            n_instance = 0
-            area = 0
-            elongation = np.nan
-            rec_area_ratio = np.nan
-            # calculate features for cxr with a pathology segmentation
-            if img_id in pos_ids:
-                gt_item = gt_seg[img_id][task]
-                gt_mask = mask.decode(gt_item)
-                if np.sum(gt_mask) > 0:
-                    # use annotation to get number of instances
-                    n_instance = len(gt_ann[img_id][task]) \
-                            if task in gt_ann[img_id] else 0
-                    # use segmentation to get other features
-                    n_instance_segm, area, elongation, rec_area_ratio = \
-                            get_geometric_features(gt_mask)
+            n_instance, area, elongation, rec_area_ratio = \
+                    features.get((img_id, task), (0, 0, np.nan, np.nan))
             n_instances.append(n_instance)
             areas.append(area)
             elongations.append(elongation)
@@ -102,10 +127,10 @@ def main(args):
     elongation_df['img_id'] = all_ids
     rec_area_ratio_df['img_id'] = all_ids
 
-    instance_df.to_csv(f'{args.save_dir}/num_instances.csv', index=False)
-    area_df.to_csv(f'{args.save_dir}/area_ratio.csv', index=False)
-    elongation_df.to_csv(f'{args.save_dir}/elongation.csv', index=False)
-    rec_area_ratio_df.to_csv(f'{args.save_dir}/rec_area_ratio.csv', index=False)
+    instance_df.to_csv(f'{save_dir}/num_instances.csv', index=False)
+    area_df.to_csv(f'{save_dir}/area_ratio.csv', index=False)
+    elongation_df.to_csv(f'{save_dir}/elongation.csv', index=False)
+    rec_area_ratio_df.to_csv(f'{save_dir}/rec_area_ratio.csv', index=False)
 
 
 if __name__ == '__main__':
@@ -114,7 +139,8 @@ if __name__ == '__main__':
                         help='path to json file with raw ground-truth annotations')
     parser.add_argument('--gt_seg', type=str,
                         help='path to json file with ground-truth segmentations \
-                              (encoded)')
+                              (encoded), \
+                              or segmentation container')
     parser.add_argument('--save_dir', default='.',
                         help='where to save feature dataframes')
     args = parser.parse_args()
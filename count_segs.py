@@ -1,42 +1,54 @@
 from argparse import ArgumentParser
-import json
-import numpy as np
 import pandas as pd
-from pycocotools import mask
 from eval_constants import LOCALIZATION_TASKS
+from segmentation_json import iter_segmentation_areas
 
 def count_segs(seg_path, save_dir):
     """
     For each pathology, count the number of CXRs with at least one segmentation.
+
+    Segmentation areas are computed from the RLE counts, so no mask is
+    decoded. Also saves the area (in pixels) of every segmentation to
+    `seg_areas.csv`, and the distribution of the areas of non-empty
+    segmentations of each pathology to `seg_area_distribution.csv`.
     """
-    with open(seg_path) as f:
-        seg_dict = json.load(f)
+    records = pd.DataFrame.from_records(
+        list(iter_segmentation_areas(seg_path)),
+        columns=['img_id', 'task', 'area'])
+    areas = records.pivot(index='img_id', columns='task', values='area')
+    areas = areas[sorted(LOCALIZATION_TASKS)]
+    if areas.isnull().values.any():
+        raise KeyError('Every CXR must have a segmentation for every pathology')
+    areas = areas.astype('int64')
+    areas.columns.name = None
+    save_counts(areas, save_dir)
 
-    cxr_ids = sorted(seg_dict.keys())
-    segmentation_label = {}
-    for task in sorted(LOCALIZATION_TASKS):
-        print(task)
-        has_seg = []
-        for cxr_id in cxr_ids:
-            seg_item = seg_dict[cxr_id][task]
-            seg_mask = mask.decode(seg_item)
-            if np.sum(seg_mask) == 0:
-                has_segmentation = 0
-            else:
-                has_segmentation = 1
-            has_seg.append(has_segmentation)
-        segmentation_label[task] = has_seg
+def save_counts(areas, save_dir):
+    """
+    Save the number of CXRs with a segmentation of each pathology and the
+    distribution of segmentation areas (see `count_segs`).
 
-    df = pd.DataFrame.from_dict(segmentation_label)
+    Args:
+        areas (pd.DataFrame): segmentation areas indexed by img_id, with one
+                              column per pathology
+        save_dir (str): where to save results
+    """
+    df = (areas > 0).astype('int64')
     n_cxr_per_pathology = df.sum()
     print(n_cxr_per_pathology)
     n_cxr_per_pathology.to_csv(f'{save_dir}/n_segs.csv')
 
+    areas.reset_index().to_csv(f'{save_dir}/seg_areas.csv', index=False)
+    distribution = areas.where(areas > 0).describe().T
+    distribution.index.name = 'task'
+    distribution.to_csv(f'{save_dir}/seg_area_distribution.csv')
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument('--seg_path', type=str,
                         help='json file path where segmentations are saved \
-                              (encoded)')
+                              (encoded), \
+                              or segmentation container')
     parser.add_argument('--save_dir', default='.',
                         help='where to save results')
     args = parser.parse_args()
@@ -1,16 +1,22 @@
 from argparse import ArgumentParser
+import hashlib
 import json
 import numpy as np
 import pandas as pd
 from pathlib import Path
-import pickle
-from PIL import Image
-from pycocotools import mask
 import torch.nn.functional as F
 from tqdm import tqdm
 
 from eval_constants import LOCALIZATION_TASKS
-from utils import CPU_Unpickler
+from ground_truth import GroundTruthIndex
+from heatmap_store import list_heatmaps, read_heatmap
+from lazy_heatmap import LazyHeatmap
+from segmentation_json import iter_segmentations
+from utils import rle_area, rle_contains, rle_intersection_area
+
+# upper bound on the number of entries in one chunk of bootstrap counts
+BOOTSTRAP_CHUNK_SIZE = 10_000_000
+INCREMENTAL_VERSION = 2
 
 
 def calculate_iou(pred_mask, gt_mask, true_pos_only):
@@ -40,12 +46,129 @@ def calculate_iou(pred_mask, gt_mask, true_pos_only):
     return iou_score
 
 
-def get_ious(gt_path, pred_path, true_pos_only):
+def calculate_rle_iou(pred_item, gt_item, true_pos_only):
+    """
+    Calculate IoU score between two RLE-encoded segmentation masks without
+    decoding them. Matches `calculate_iou` on the decoded masks.
+
+    Args:
+        pred_item (dict): predicted segmentation in RLE format; None for an
+                          all-zero mask
+        gt_item (dict): ground-truth segmentation in RLE format; None for an
+                        all-zero mask
+    Returns:
+        iou_score (np.float64)
+    """
+    pred_area = 0 if pred_item is None else rle_area(pred_item)
+    gt_area = 0 if gt_item is None else rle_area(gt_item)
+
+    if pred_area == 0 or gt_area == 0:
+        intersection = 0
+    else:
+        intersection = rle_intersection_area(pred_item, gt_item)
+    return iou_from_areas(pred_area, gt_area, intersection, true_pos_only)
+
+
+def iou_from_areas(pred_area, gt_area, intersection, true_pos_only):
+    """
+    Calculate IoU score from the areas of two segmentation masks and of their
+    intersection, with the conventions of `calculate_iou`.
+
+    Returns:
+        iou_score (np.float64)
+    """
+    union = pred_area + gt_area - intersection
+
+    if true_pos_only:
+        if pred_area == 0 or gt_area == 0:
+            iou_score = np.nan
+        else:
+            iou_score = np.float64(intersection) / union
+    else:
+        if union == 0:
+            iou_score = np.nan
+        else:
+            iou_score = np.float64(intersection) / union
+
+    return iou_score
+
+
+def rle_fingerprint(pred_item, gt_item):
+    """
+    Fingerprint of the predicted and ground-truth segmentations of a
+    (cxr_id, task) pair: the IoU of two pairs with the same fingerprint is
+    the same.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for item in (pred_item, gt_item):
+        if item is None:
+            digest.update(b'none;')
+        else:
+            h, w = item['size']
+            digest.update(f'{h},{w}:{item["counts"]};'.encode())
+    return digest.hexdigest()
+
+
+class IncrementalIoUs:
+    """
+    IoU scores of the previous evaluation saved in `save_dir`, reused for the
+    (cxr_id, task) pairs whose segmentations did not change.
+
+    The previous scores and the fingerprints of their segmentations are read
+    from `iou_fingerprints.json`, which `save` writes next to the results, so
+    they do not depend on results saved by other evaluations. Scores are only
+    reused with the same `true_pos_only`.
+
+    Args:
+        save_dir (str): where results are saved
+        true_pos_only (bool): see `get_ious`
+    """
+    def __init__(self, save_dir, true_pos_only):
+        self.fingerprint_path = Path(save_dir) / 'iou_fingerprints.json'
+        self.true_pos_only = true_pos_only
+        self.previous = {}
+        self.scores = {}
+        self.recomputed = 0
+
+        if not self.fingerprint_path.is_file():
+            return
+        with open(self.fingerprint_path) as f:
+            saved = json.load(f)
+        if saved['version'] != INCREMENTAL_VERSION or \
+                saved['true_pos_only'] != true_pos_only:
+            return
+        for cxr_id, scores in saved['scores'].items():
+            for task, (fingerprint, iou) in scores.items():
+                self.previous[(cxr_id, task)] = (fingerprint, np.float64(iou))
+
+    def iou(self, cxr_id, task, pred_item, gt_item):
+        """Return the IoU of a pair, computed only if it changed."""
+        fingerprint = rle_fingerprint(pred_item, gt_item)
+        previous = self.previous.get((cxr_id, task))
+        if previous is not None and previous[0] == fingerprint:
+            iou = previous[1]
+        else:
+            self.recomputed += 1
+            iou = calculate_rle_iou(pred_item, gt_item, self.true_pos_only)
+        self.scores.setdefault(cxr_id, {})[task] = (fingerprint, float(iou))
+        return iou
+
+    def save(self):
+        """Save the scores of this evaluation and their fingerprints."""
+        with open(self.fingerprint_path, 'w') as f:
+            json.dump({'version': INCREMENTAL_VERSION,
+                       'true_pos_only': self.true_pos_only,
+                       'scores': self.scores}, f)
+
+
+def get_ious(gt_path, pred_path, true_pos_only, incremental=None):
     """
     Returns IoU scores for each combination of CXR and pathology in gt_path and pred_path.
 
     Args:
-        gt_path (str): path to ground-truth segmentation json file (encoded)
+        gt_path (str or GroundTruthIndex): path to ground-truth segmentation
+                                           json file (encoded), or the
+                                           already loaded ground truth
         pred_path (str): path to predicted segmentation json file (encoded)
         true_pos_only (bool): if true, run evaluation only on the true positive
                               slice of the dataset (CXRs that contain predicted
@@ -54,79 +177,121 @@ def get_ious(gt_path, pred_path, true_pos_only):
                               without a ground-truth segmentation, and include
                               CXRs with a ground-truth segmentation but without
                               a predicted segmentation.
+        incremental (IncrementalIoUs): if given, reuse the IoU scores of the
+                                       previous evaluation for unchanged
+                                       segmentations
 
     Returns:
         ious (dict): dict with 10 keys, one for each pathology (task). Values
                      are lists of all CXR IoU scores for the pathology key.
         cxr_ids (list): list of all CXR ids (e.g. 'patient64541_study1_view1_frontal').
     """
-    with open(gt_path) as f:
-        gt_dict = json.load(f)
+    gt = GroundTruthIndex.load(gt_path)
+    tasks = sorted(LOCALIZATION_TASKS)
 
-    with open(pred_path) as f:
-        pred_dict = json.load(f)
+    # stream the predicted segmentations (kept in RLE format) and score each
+    # one as it is read, so the prediction file is never fully loaded
+    if incremental is None:
+        def score(cxr_id, task, pred_item, gt_item):
+            return calculate_rle_iou(pred_item, gt_item, true_pos_only)
+    else:
+        score = incremental.iou
 
-    ious = {}
-    tasks = sorted(LOCALIZATION_TASKS)
+    pred_ious = {}
+    extra_ious = {}
+    print(f'Evaluating {pred_path}')
+    for cxr_id, task, pred_item in iter_segmentations(pred_path):
+        if task not in tasks:
+            continue
+        if cxr_id in gt:
+            gt_item = gt.item(cxr_id, task)
+            assert list(gt_item['size']) == list(pred_item['size'])
+            pred_ious[(cxr_id, task)] = score(cxr_id, task, pred_item,
+                                              gt_item)
+        elif not true_pos_only:
+            extra_ious.setdefault(cxr_id, {})[task] = \
+                score(cxr_id, task, pred_item, None)
 
-    for task in tasks:
-        cxr_ids = sorted(gt_dict.keys())
-        print(f'Evaluating {task}')
-        ious[task] = []
+    if incremental is not None:
+        print(f'Recomputed {incremental.recomputed} of '
+              f'{len(pred_ious) + sum(map(len, extra_ious.values()))} '
+              f'IoU scores')
 
-        for cxr_id in cxr_ids:
-            # get ground-truth segmentation mask
-            gt_item = gt_dict[cxr_id][task]
-            gt_mask = mask.decode(gt_item)
+    return collect_ious(gt, pred_ious, extra_ious, true_pos_only)
 
-            # get predicted segmentation mask
-            if cxr_id not in pred_dict:
-                pred_mask = np.zeros(gt_item['size'])
-            else:
-                pred_item = pred_dict[cxr_id][task]
-                pred_mask = mask.decode(pred_item)
 
-            assert gt_mask.shape == pred_mask.shape
+def collect_ious(gt, pred_ious, extra_ious, true_pos_only):
+    """
+    Arrange IoU scores computed in any order as `get_ious` returns them.
 
-            iou_score = calculate_iou(pred_mask, gt_mask, true_pos_only)
+    Args:
+        gt (GroundTruthIndex): ground-truth segmentations
+        pred_ious (dict): {(cxr_id, task): IoU} for CXRs with a ground truth
+                          and a predicted segmentation; other CXRs of the
+                          ground truth are scored as all-zero predictions
+        extra_ious (dict): {cxr_id: {task: IoU}} for CXRs with a predicted
+                           segmentation only (used if true_pos_only is false)
+        true_pos_only (bool): see `get_ious`
+    """
+    ious = {}
+    for task in sorted(LOCALIZATION_TASKS):
+        cxr_ids = list(gt.cxr_ids)
+        ious[task] = []
+
+        for cxr_id in cxr_ids:
+            # a missing predicted segmentation is an all-zero mask
+            if (cxr_id, task) in pred_ious:
+                iou_score = pred_ious[(cxr_id, task)]
+            else:
+                iou_score = calculate_rle_iou(None, gt.item(cxr_id, task),
+                                              true_pos_only)
             ious[task].append(iou_score)
 
         # if true_pos_only is false, include cxrs that do not have ground-truth
         # segmentations but that have predicted segmentations
         if not true_pos_only:
-            for cxr_id in sorted(pred_dict.keys()):
-                if cxr_id not in gt_dict:
-                    pred_item = pred_dict[cxr_id][task]
-                    pred_mask = mask.decode(pred_item)
-                    gt_mask = np.zeros(pred_item['size'])
-                    assert gt_mask.shape == pred_mask.shape
-                    iou_score = calculate_iou(pred_mask, gt_mask, true_pos_only)
-                    ious[task].append(iou_score)
-                    cxr_ids.append(cxr_id)
+            for cxr_id in sorted(extra_ious.keys()):
+                ious[task].append(extra_ious[cxr_id][task])
+                cxr_ids.append(cxr_id)
         else:
-            assert len(ious[task]) == len(gt_dict.keys())
+            assert len(ious[task]) == len(gt)
 
     return ious, cxr_ids
 
 
-def bootstrap_metric(df, num_replicates):
-    """Create dataframe of bootstrap samples."""
-    def single_replicate_performances():
-        sample_ids = np.random.choice(len(df), size=len(df), replace=True)
-        replicate_performances = {}
-        df_replicate = df.iloc[sample_ids]
+def bootstrap_metric(df, num_replicates, seed=None):
+    """
+    Create dataframe of bootstrap samples.
 
-        for task in df[LOCALIZATION_TASKS].columns:
-            performance = df_replicate[task].mean()
-            replicate_performances[task] = performance
-        return replicate_performances
+    Each replicate is represented by how many times it resamples every CXR,
+    so the NaN-aware means of all pathologies across all replicates reduce to
+    two matrix products. Replicates are drawn in chunks to bound memory.
 
-    all_performances = []
-    for _ in range(num_replicates):
-        replicate_performances = single_replicate_performances()
-        all_performances.append(replicate_performances)
+    Args:
+        df (pd.DataFrame): per-CXR metric, one column per pathology
+        num_replicates (int): number of bootstrap replicates
+        seed (int): seed of the random generator, for reproducible samples
+    """
+    rng = np.random.default_rng(seed)
+    values = df[LOCALIZATION_TASKS].to_numpy(dtype=np.float64)
+    n = len(values)
+    observed = ~np.isnan(values)
+    values = np.where(observed, values, 0.)
 
-    df_performances = pd.DataFrame.from_records(all_performances)
+    chunk_size = max(1, BOOTSTRAP_CHUNK_SIZE // max(n, 1))
+    all_performances = []
+    for start in range(0, num_replicates, chunk_size):
+        size = min(chunk_size, num_replicates - start)
+        sample_ids = rng.integers(0, n, size=(size, n))
+        sample_ids += np.arange(size)[:, None] * n
+        counts = np.bincount(sample_ids.ravel(),
+                             minlength=size * n).reshape(size, n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            performances = (counts @ values) / (counts @ observed)
+        all_performances.append(performances)
+
+    df_performances = pd.DataFrame(np.concatenate(all_performances),
+                                   columns=LOCALIZATION_TASKS)
     return df_performances
 
 
@@ -150,7 +315,7 @@ def create_ci_record(perfs, task):
 
 
 def get_map(pkl_path):
-    info = CPU_Unpickler(open(pkl_path, 'rb')).load()
+    info = read_heatmap(pkl_path)
     saliency_map = info['map']
     img_dims = info['cxr_dims']
     map_resized = F.interpolate(saliency_map, size=(img_dims[1],img_dims[0]),
@@ -162,13 +327,15 @@ def get_map(pkl_path):
 def get_hitrates(gt_path, pred_path):
     """
 	Args:
-        gt_path (str): directory where ground-truth segmentations are saved (encoded)
-        pred_path (str): directory with pickle file containing heat maps
+        gt_path (str or GroundTruthIndex): directory where ground-truth
+                                           segmentations are saved (encoded),
+                                           or the already loaded ground truth
+        pred_path (str): directory with pickle file containing heat maps, or
+                         heatmap store
     """
-    with open(gt_path) as f:
-        gt_dict = json.load(f)
-	
-    all_paths = sorted(list(Path(pred_path).rglob("*_map.pkl")))
+    gt = GroundTruthIndex.load(gt_path)
+
+    all_paths = list_heatmaps(pred_path)
     results = {}
     for pkl_path in tqdm(all_paths):
         # break down path to image name and task
@@ -188,27 +355,30 @@ def get_hitrates(gt_path, pred_path):
                 results[img_id][task] = 0
         else:
             # get ground truth binary mask
-            if img_id not in gt_dict:
+            if img_id not in gt:
                 continue
             else:
                 results[img_id] = {}
                 results[img_id][task] = 0
 
-        gt_item = gt_dict[img_id][task]
-        gt_mask = mask.decode(gt_item)
+        # a cxr without a ground-truth segmentation can never be a hit
+        if gt.is_empty(img_id, task):
+            results[img_id][task] = np.nan
+            continue
+
+        gt_item = gt.item(img_id, task)
 
-        # get saliency heatmap
-        sal_map = get_map(pkl_path)
-        x = np.unravel_index(np.argmax(sal_map, axis = None), sal_map.shape)[0]
-        y = np.unravel_index(np.argmax(sal_map, axis = None), sal_map.shape)[1]
+        # locate the peak of the upsampled saliency heatmap from its native
+        # resolution, and look it up in the encoded ground truth
+        info = read_heatmap(pkl_path)
+        sal_map = LazyHeatmap(info['map'], info['cxr_dims'])
+        x, y = sal_map.argmax()
 
-        assert (gt_mask.shape == sal_map.shape)
-        if (gt_mask[x][y]==1):
+        assert (gt.size(img_id, task) == sal_map.shape)
+        if rle_contains(gt_item, x, y):
             results[img_id][task] = 1
-        elif (np.sum(gt_mask)==0):
-            results[img_id][task] = np.nan
 
-    all_ids = sorted(gt_dict.keys())
+    all_ids = list(gt.cxr_ids)
     results_df = pd.DataFrame.from_dict(results, orient='index')
     return results_df, all_ids
 
@@ -216,32 +386,31 @@ def get_hitrates(gt_path, pred_path):
 def get_hb_hitrates(gt_path, pred_path):
     """
 	Args:
-        gt_path (str): directory where ground-truth segmentations are saved (encoded)
+        gt_path (str or GroundTruthIndex): directory where ground-truth
+                                           segmentations are saved (encoded),
+                                           or the already loaded ground truth
         pred_path (str): json file with human annotations for most representative point
     """
     with open(pred_path) as f:
         hb_salient_pts = json.load(f)
-    with open(gt_path) as f:
-        gt_dict = json.load(f)
+    gt = GroundTruthIndex.load(gt_path)
 
     # evaluate hit
     results = {}
-    all_ids = sorted(gt_dict.keys())
+    all_ids = list(gt.cxr_ids)
     for task in sorted(LOCALIZATION_TASKS):
         print(f'Evaluating {task}')
         results[task] = []
         for img_id in all_ids:
             hit = np.nan
-            gt_item = gt_dict[img_id][task]
-            gt_mask = mask.decode(gt_item)
 
-            if np.sum(gt_mask) !=0:
+            if not gt.is_empty(img_id, task):
                 if img_id in hb_salient_pts and task in hb_salient_pts[img_id]:
                     salient_pts = hb_salient_pts[img_id][task]
-                    hit = 0
-                    for pt in salient_pts:
-                        if gt_mask[int(pt[1]), int(pt[0])]:
-                            hit = 1
+                    rows = [int(pt[1]) for pt in salient_pts]
+                    cols = [int(pt[0]) for pt in salient_pts]
+                    hits = rle_contains(gt.item(img_id, task), rows, cols)
+                    hit = int(np.any(hits))
                 else:
                     hit = 0
 
@@ -253,36 +422,70 @@ def get_hb_hitrates(gt_path, pred_path):
     return results_df, all_ids
 
 
-def evaluate(gt_path, pred_path, save_dir, metric, true_pos_only, if_human_benchmark):
+def evaluate(gt_path, pred_path, save_dir, metric, true_pos_only,
+             if_human_benchmark, num_replicates=1000, seed=0,
+             incremental=False):
     """
 	Generates and saves three csv files:
 	-- `{iou/hitmiss}_results.csv`: IoU or hit/miss results for each CXR and
                                      each pathology.
-	-- `{iou/hitmiss}_bootstrap_results.csv`: 1000 bootstrap samples of IoU
-                                               or hit/miss for each pathology.
+	-- `{iou/hitmiss}_bootstrap_results.csv`: `num_replicates` bootstrap
+                                               samples of IoU or hit/miss for
+                                               each pathology.
 	-- `{miou/hitrate}_summary_results.csv`: mIoU or hit rate 95% bootstrap
                                              confidence intervals for each pathology.
+
+    With `incremental` (IoU only), the IoU scores saved in `save_dir` by the
+    previous incremental evaluation are reused for the (cxr_id, task) pairs
+    whose predicted and ground-truth segmentations are unchanged, and the
+    scores are saved with their fingerprints to `iou_fingerprints.json` in
+    `save_dir` for the next one. The bootstrap is always rerun.
     """
     # create save_dir if it does not already exist
     Path(save_dir).mkdir(exist_ok=True, parents=True)
 
-    if metric == 'iou':
-        ious, cxr_ids = get_ious(gt_path, pred_path, true_pos_only)
-        metric_df = pd.DataFrame.from_dict(ious)
-    elif metric == 'hitmiss' and if_human_benchmark == False:
-        metric_df, cxr_ids = get_hitrates(gt_path, pred_path)
-    elif metric == 'hitmiss' and if_human_benchmark == True:
-        metric_df, cxr_ids = get_hb_hitrates(gt_path, pred_path)
-    else:
+    if metric not in ['iou', 'hitmiss']:
         raise ValueError('`metric` must be either `iou` or `hitmiss`')
 
+    if incremental and metric != 'iou':
+        raise ValueError('incremental evaluation is only supported for `iou`')
+
+    # parse the ground truth once and share it across the metric paths
+    with GroundTruthIndex.load(gt_path) as gt:
+        if metric == 'iou':
+            previous = None
+            if incremental:
+                previous = IncrementalIoUs(save_dir, true_pos_only)
+            ious, cxr_ids = get_ious(gt, pred_path, true_pos_only, previous)
+            metric_df = pd.DataFrame.from_dict(ious)
+        elif if_human_benchmark == False:
+            metric_df, cxr_ids = get_hitrates(gt, pred_path)
+        else:
+            metric_df, cxr_ids = get_hb_hitrates(gt, pred_path)
+
+        save_results(metric_df, cxr_ids, save_dir, metric, if_human_benchmark,
+                     num_replicates, seed)
+        if incremental:
+            previous.save()
+
+
+def save_results(metric_df, cxr_ids, save_dir, metric, if_human_benchmark,
+                 num_replicates=1000, seed=0):
+    """
+    Save per-CXR results, their bootstrap replicates and confidence intervals
+    (see `evaluate`).
+
+    Args:
+        metric_df (pd.DataFrame): one column per pathology, one row per CXR
+        cxr_ids (list): CXR id of every row of `metric_df`
+    """
     hb = 'humanbenchmark_' if if_human_benchmark else ''
 
     metric_df['img_id'] = cxr_ids
     metric_df = metric_df.sort_values(by='img_id')
     metric_df.to_csv(f'{save_dir}/{metric}_{hb}results_per_cxr.csv', index=False)
 
-    bs_df = bootstrap_metric(metric_df, 1000)
+    bs_df = bootstrap_metric(metric_df, num_replicates, seed)
     bs_df.to_csv(f'{save_dir}/{metric}_{hb}bootstrap_results_per_cxr.csv', index=False)
 
     # get confidence intervals
@@ -301,11 +504,14 @@ if __name__ == '__main__':
                         help='options are: iou or hitmiss')
     parser.add_argument('--gt_path', type=str,
                         help='directory where ground-truth segmentations are \
-                              saved (encoded)')
+                              saved (encoded), \
+                              or segmentation container')
     parser.add_argument('--pred_path', type=str,
-                        help='json path where predicted segmentations are saved \
+                        help='json path (or segmentation container) where predicted \
+                              segmentations are saved \
                               (if metric = iou) or directory with pickle files \
-							  containing heat maps (if metric = hitmiss and \
+							  containing heat maps or heatmap store (if metric \
+                              = hitmiss and \
                               if_human_benchmark = false) or json path with \
                               human annotations for most representative points \
                               (if metric = hitmiss and if_human_benchmark = \
@@ -323,14 +529,22 @@ if __name__ == '__main__':
                         help='if true, scripts expects human benchmark inputs')
     parser.add_argument('--seed', type=int, default=0,
                         help='random seed to fix')
+    parser.add_argument('--num_replicates', type=int, default=1000,
+                        help='number of bootstrap replicates')
+    parser.add_argument('--incremental', type=str, default='False',
+                        help='if true (metric = iou only), reuse the IoU \
+                              scores saved in save_dir by the previous \
+                              incremental run for the segmentations that did \
+                              not change, and rerun the bootstrap')
     args = parser.parse_args()
 
     assert args.metric in ['iou', 'hitmiss'], \
         "`metric` flag must be either `iou` or `hitmiss`"
     assert args.if_human_benchmark in ['True', 'False'], \
         "`if_human_benchmark` flag must be either `True` or `False`"
-
-    np.random.seed(args.seed)
+    assert args.incremental in ['True', 'False'], \
+        "`incremental` flag must be either `True` or `False`"
 
     evaluate(args.gt_path, args.pred_path, args.save_dir, args.metric,
-             eval(args.true_pos_only), eval(args.if_human_benchmark))
+             eval(args.true_pos_only), eval(args.if_human_benchmark),
+             args.num_replicates, args.seed, eval(args.incremental))
@@ -0,0 +1,294 @@
+"""
+Runs every segmentation evaluation in a single pass over the ground truth:
+IoU (`eval.py --metric iou`), precision/recall/specificity
+(`precision_recall_specificity.py`), segmentation counts (`count_segs.py`)
+and pathology features (`compute_pathology_features.py`), plus hit/miss
+evaluations when heatmaps or human benchmark points are given.
+
+The ground truth is loaded and indexed once. Each (cxr_id, task) pair is
+visited once per segmentation source and handed to every metric
+accumulator; areas and intersections are computed at most once per pair, and
+a ground-truth mask is decoded at most once, only for the features of a
+non-empty segmentation. Every output csv is the same as the one of the
+corresponding script, and all of them are saved to `save_dir`.
+"""
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser
+from functools import cached_property
+import json
+import pandas as pd
+from pathlib import Path
+from pycocotools import mask
+from tqdm import tqdm
+
+from compute_pathology_features import get_features, save_features
+from count_segs import save_counts
+from eval import (collect_ious, get_hb_hitrates, get_hitrates, iou_from_areas,
+                  save_results)
+from eval_constants import LOCALIZATION_TASKS
+from ground_truth import GroundTruthIndex
+from precision_recall_specificity import (add_counts, counts_from_areas,
+                                          empty_results)
+from precision_recall_specificity import save_results as save_prs_results
+from segmentation_json import iter_segmentations
+from utils import rle_area, rle_intersection_area
+
+
+class SegmentationPair:
+    """
+    Ground-truth segmentation of a (cxr_id, task) pair and the segmentation of
+    the evaluated source (None if the source has none). Areas and the decoded
+    ground-truth mask are computed on first use and shared by accumulators.
+    """
+    def __init__(self, gt, cxr_id, task, seg_item):
+        self.gt = gt
+        self.cxr_id = cxr_id
+        self.task = task
+        self.seg_item = seg_item
+        self.gt_item = gt.item(cxr_id, task)
+        if seg_item is not None:
+            assert list(self.gt_item['size']) == list(seg_item['size'])
+
+    @cached_property
+    def gt_area(self):
+        return self.gt.area(self.cxr_id, self.task)
+
+    @cached_property
+    def seg_area(self):
+        return 0 if self.seg_item is None else rle_area(self.seg_item)
+
+    @cached_property
+    def intersection(self):
+        if self.seg_area == 0 or self.gt_area == 0:
+            return 0
+        return rle_intersection_area(self.seg_item, self.gt_item)
+
+    @cached_property
+    def num_pixels(self):
+        h, w = self.gt_item['size']
+        return h * w
+
+    @cached_property
+    def gt_mask(self):
+        return mask.decode(self.gt_item)
+
+
+class MetricAccumulator(ABC):
+    """Collects one metric over the pairs of a segmentation source."""
+    @abstractmethod
+    def add(self, pair):
+        """Add a pair with a ground-truth segmentation."""
+
+    def add_unmatched(self, cxr_id, task, seg_item):
+        """Add a segmentation of a CXR without ground truth."""
+        pass
+
+    @abstractmethod
+    def save(self, save_dir):
+        """Save the metric to csv files in `save_dir`."""
+
+
+class IoUAccumulator(MetricAccumulator):
+    """IoU of predicted segmentations, saved as `eval.py --metric iou`."""
+    def __init__(self, gt, true_pos_only, num_replicates, seed):
+        self.gt = gt
+        self.true_pos_only = true_pos_only
+        self.num_replicates = num_replicates
+        self.seed = seed
+        self.pred_ious = {}
+        self.extra_ious = {}
+
+    def add(self, pair):
+        self.pred_ious[(pair.cxr_id, pair.task)] = iou_from_areas(
+            pair.seg_area, pair.gt_area, pair.intersection, self.true_pos_only)
+
+    def add_unmatched(self, cxr_id, task, seg_item):
+        if not self.true_pos_only:
+            self.extra_ious.setdefault(cxr_id, {})[task] = iou_from_areas(
+                rle_area(seg_item), 0, 0, self.true_pos_only)
+
+    def save(self, save_dir):
+        ious, cxr_ids = collect_ious(self.gt, self.pred_ious, self.extra_ious,
+                                     self.true_pos_only)
+        save_results(pd.DataFrame.from_dict(ious), cxr_ids, save_dir, 'iou',
+                     False, self.num_replicates, self.seed)
+
+
+class ConfusionAccumulator(MetricAccumulator):
+    """TP/TN/FP/FN pixel counts, saved as precision_recall_specificity.py."""
+    def __init__(self, source):
+        self.source = source
+        self.results = empty_results()
+
+    def add(self, pair):
+        add_counts(self.results, pair.task,
+                   counts_from_areas(pair.seg_area, pair.gt_area,
+                                     pair.intersection, pair.num_pixels))
+
+    def save(self, save_dir):
+        save_prs_results(self.results, self.source, save_dir)
+
+
+class AreaAccumulator(MetricAccumulator):
+    """Ground-truth segmentation areas, saved as count_segs.py."""
+    def __init__(self):
+        self.areas = {}
+
+    def add(self, pair):
+        self.areas.setdefault(pair.cxr_id, {})[pair.task] = pair.gt_area
+
+    def save(self, save_dir):
+        areas = pd.DataFrame.from_dict(self.areas, orient='index')
+        areas = areas[sorted(LOCALIZATION_TASKS)].sort_index()
+        areas.index.name = 'img_id'
+        save_counts(areas.astype('int64'), save_dir)
+
+
+class FeatureAccumulator(MetricAccumulator):
+    """Pathology features, saved as compute_pathology_features.py."""
+    def __init__(self, gt_ann):
+        self.gt_ann = gt_ann
+        self.features = {}
+
+    def add(self, pair):
+        # only decode segmentations that have a pathology
+        if pair.cxr_id in self.gt_ann and pair.gt_area > 0:
+            self.features[(pair.cxr_id, pair.task)] = get_features(
+                self.gt_ann, pair.cxr_id, pair.task, pair.gt_mask)
+
+    def save(self, save_dir):
+        save_features(self.features, sorted(self.gt_ann.keys()), save_dir)
+
+
+def evaluate_source(gt, seg_path, accumulators):
+    """
+    Visit every (cxr_id, task) pair of the ground truth once, with the
+    segmentation of `seg_path` if any, and add it to the accumulators.
+
+    Args:
+        gt (GroundTruthIndex): ground-truth segmentations
+        seg_path (str): json file or container with the segmentations of the
+                        source; None to visit ground-truth segmentations only
+        accumulators (list): MetricAccumulator objects
+    """
+    tasks = sorted(LOCALIZATION_TASKS)
+    seen = set()
+    if seg_path is not None:
+        print(f'Evaluating {seg_path}')
+        for cxr_id, task, seg_item in tqdm(iter_segmentations(seg_path)):
+            if task not in tasks:
+                continue
+            if cxr_id not in gt:
+                for accumulator in accumulators:
+                    accumulator.add_unmatched(cxr_id, task, seg_item)
+                continue
+            seen.add((cxr_id, task))
+            pair = SegmentationPair(gt, cxr_id, task, seg_item)
+            for accumulator in accumulators:
+                accumulator.add(pair)
+
+    # a missing segmentation is an all-zero mask
+    for cxr_id in gt.cxr_ids:
+        for task in tasks:
+            if (cxr_id, task) not in seen:
+                pair = SegmentationPair(gt, cxr_id, task, None)
+                for accumulator in accumulators:
+                    accumulator.add(pair)
+
+
+def evaluate_all(gt_path, save_dir, pred_path=None, hb_seg_path=None,
+                 gt_ann_path=None, map_dir=None, hb_pts_path=None,
+                 true_pos_only=True, num_replicates=1000, seed=0):
+    """
+    Run every evaluation whose inputs are given and save their csv files to
+    `save_dir`.
+
+    Args:
+        gt_path (str): ground-truth segmentations (json or container)
+        save_dir (str): where to save results
+        pred_path (str): predicted segmentations, for IoU and
+                         precision/recall/specificity
+        hb_seg_path (str): human benchmark segmentations, for
+                           precision/recall/specificity
+        gt_ann_path (str): raw ground-truth annotations, for pathology features
+        map_dir (str): heatmaps (pickle files or store), for hit/miss
+        hb_pts_path (str): human benchmark points, for hit/miss
+        true_pos_only (bool): see `eval.get_ious`
+        num_replicates (int): number of bootstrap replicates
+        seed (int): random seed of the bootstrap
+    """
+    Path(save_dir).mkdir(exist_ok=True, parents=True)
+
+    # parse the ground truth once and share it across every metric
+    with GroundTruthIndex.load(gt_path) as gt:
+        gt_accumulators = [AreaAccumulator()]
+        if gt_ann_path is not None:
+            with open(gt_ann_path) as f:
+                gt_accumulators.append(FeatureAccumulator(json.load(f)))
+
+        pred_accumulators = []
+        if pred_path is not None:
+            pred_accumulators = [IoUAccumulator(gt, true_pos_only,
+                                                num_replicates, seed),
+                                 ConfusionAccumulator('pred')]
+        evaluate_source(gt, pred_path, pred_accumulators + gt_accumulators)
+
+        hb_accumulators = []
+        if hb_seg_path is not None:
+            hb_accumulators = [ConfusionAccumulator('hb')]
+            evaluate_source(gt, hb_seg_path, hb_accumulators)
+
+        for accumulator in (pred_accumulators + hb_accumulators +
+                            gt_accumulators):
+            accumulator.save(save_dir)
+
+        if map_dir is not None:
+            metric_df, cxr_ids = get_hitrates(gt, map_dir)
+            save_results(metric_df, cxr_ids, save_dir, 'hitmiss', False,
+                         num_replicates, seed)
+        if hb_pts_path is not None:
+            metric_df, cxr_ids = get_hb_hitrates(gt, hb_pts_path)
+            save_results(metric_df, cxr_ids, save_dir, 'hitmiss', True,
+                         num_replicates, seed)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--gt_path', type=str,
+                        help='json file path where ground-truth segmentations \
+                              are saved (encoded), or segmentation container')
+    parser.add_argument('--pred_path', type=str, default=None,
+                        help='json file path (or segmentation container) where \
+                              predicted segmentations are saved; enables IoU \
+                              and precision/recall/specificity')
+    parser.add_argument('--hb_seg_path', type=str, default=None,
+                        help='json file path (or segmentation container) where \
+                              human benchmark segmentations are saved; enables \
+                              human benchmark precision/recall/specificity')
+    parser.add_argument('--gt_ann', type=str, default=None,
+                        help='path to json file with raw ground-truth \
+                              annotations; enables pathology features')
+    parser.add_argument('--map_dir', type=str, default=None,
+                        help='directory with pickle files containing heatmaps, \
+                              or heatmap store; enables hit/miss')
+    parser.add_argument('--hb_pts_path', type=str, default=None,
+                        help='json path with human annotations for most \
+                              representative points; enables human benchmark \
+                              hit/miss')
+    parser.add_argument('--true_pos_only', type=str, default='True',
+                        help='if true, compute IoU only on the true positive \
+                              slice of the dataset (see eval.py)')
+    parser.add_argument('--save_dir', default='.',
+                        help='where to save evaluation results')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed to fix')
+    parser.add_argument('--num_replicates', type=int, default=1000,
+                        help='number of bootstrap replicates')
+    args = parser.parse_args()
+
+    assert args.true_pos_only in ['True', 'False'], \
+        "`true_pos_only` flag must be either `True` or `False`"
+
+    evaluate_all(args.gt_path, args.save_dir, args.pred_path,
+                 args.hb_seg_path, args.gt_ann, args.map_dir, args.hb_pts_path,
+                 eval(args.true_pos_only), args.num_replicates, args.seed)
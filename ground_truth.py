@@ -0,0 +1,98 @@
+"""
+Ground-truth segmentations indexed for the evaluation scripts, from an
+encoded segmentation json file or a segmentation container.
+"""
+from collections.abc import Mapping
+from pycocotools import mask
+
+from segmentation_container import SegmentationContainer
+from segmentation_json import load_segmentations
+
+
+class GroundTruthIndex:
+    """
+    Ground-truth segmentations (encoded) loaded once and indexed by CXR id and
+    pathology. Areas, bounding boxes and empty flags are computed from the RLE
+    counts, so none of them require decoding a mask. A segmentation container
+    already stores them, and is read lazily.
+
+    Args:
+        gt_dict (dict or SegmentationContainer): {cxr_id: {task: RLE}}
+                                                 ground-truth segmentations
+    """
+    def __init__(self, gt_dict):
+        self.gt_dict = gt_dict
+        self.cxr_ids = sorted(gt_dict.keys())
+
+        if isinstance(gt_dict, SegmentationContainer):
+            self.areas = self.bboxes = None
+            return
+
+        keys = [(cxr_id, task) for cxr_id in self.cxr_ids
+                for task in gt_dict[cxr_id]]
+        items = [gt_dict[cxr_id][task] for cxr_id, task in keys]
+        if items:
+            areas = mask.area(items).tolist()
+            bboxes = mask.toBbox(items).tolist()
+        else:
+            areas, bboxes = [], []
+        self.areas = dict(zip(keys, areas))
+        self.bboxes = dict(zip(keys, bboxes))
+
+    @classmethod
+    def load(cls, gt_path):
+        """
+        Load ground truth from a json file or a segmentation container, unless
+        it is already loaded (as a dictionary) or indexed.
+        """
+        if isinstance(gt_path, cls):
+            return gt_path
+        if isinstance(gt_path, Mapping):
+            return cls(gt_path)
+        return cls(load_segmentations(gt_path))
+
+    def __contains__(self, cxr_id):
+        return cxr_id in self.gt_dict
+
+    def __len__(self):
+        return len(self.gt_dict)
+
+    def keys(self):
+        return self.gt_dict.keys()
+
+    def item(self, cxr_id, task):
+        """Return the encoded segmentation of `task` for `cxr_id`."""
+        if self.areas is None:
+            return self.gt_dict.item(cxr_id, task)
+        return self.gt_dict[cxr_id][task]
+
+    def size(self, cxr_id, task):
+        """Return the (h, w) of the segmentation."""
+        return tuple(self.item(cxr_id, task)['size'])
+
+    def area(self, cxr_id, task):
+        """Return the number of foreground pixels in the segmentation."""
+        if self.areas is None:
+            return self.gt_dict.area(cxr_id, task)
+        return self.areas[(cxr_id, task)]
+
+    def bbox(self, cxr_id, task):
+        """Return the [x, y, w, h] bounding box of the segmentation."""
+        if self.bboxes is None:
+            return self.gt_dict.bbox(cxr_id, task)
+        return self.bboxes[(cxr_id, task)]
+
+    def is_empty(self, cxr_id, task):
+        """Return True if the segmentation has no foreground pixels."""
+        return self.area(cxr_id, task) == 0
+
+    def close(self):
+        """Close the file of a container (reopened if read again)."""
+        if isinstance(self.gt_dict, SegmentationContainer):
+            self.gt_dict.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
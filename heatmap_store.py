@@ -0,0 +1,197 @@
+"""
+Packs a directory of heatmap pickle files into a compact store that can be
+memory-mapped, so that scripts do not need to unpickle a whole torch object
+per heatmap just to read its map, probability, task and CXR dimensions.
+
+A store is a directory with three files:
+-- `store.json`: format version and dtype of the maps.
+-- `maps.bin`: the low-resolution saliency maps, flattened and concatenated.
+-- `index.csv`: one row per heatmap with its img_id, task, offset and shape
+                in `maps.bin`, the original CXR dimensions and the model
+                probability for the task.
+
+Every script that takes `--map_dir` (or a directory of pickle files) also
+accepts a store directory. Maps are stored as float32 by default, which gives
+the same results as the pickle files; float16 halves the size but is lossy.
+"""
+from argparse import ArgumentParser
+import fnmatch
+from functools import lru_cache
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import torch
+from tqdm import tqdm
+
+from eval_constants import CHEXPERT_TASKS
+from utils import CPU_Unpickler, parse_pkl_filename
+
+STORE_VERSION = 1
+
+
+class StoredHeatmap:
+    """
+    Reference to one heatmap of a store. Its string form mimics the path of
+    the original pickle file so `parse_pkl_filename` keeps working.
+    """
+    def __init__(self, store_dir, row, img_id, task):
+        self.store_dir = str(store_dir)
+        self.row = row
+        self.img_id = img_id
+        self.task = task
+        self.name = f'{img_id}_{task}_map.pkl'
+
+    def __str__(self):
+        return f'{self.store_dir}/{self.name}'
+
+    def __repr__(self):
+        return f'StoredHeatmap({str(self)!r})'
+
+    def __lt__(self, other):
+        return str(self) < str(other)
+
+
+class HeatmapStore:
+    """
+    Random-access reader of a heatmap store.
+
+    Args:
+        store_dir (str): directory written by `convert`
+    """
+    def __init__(self, store_dir):
+        self.store_dir = str(store_dir)
+        with open(Path(store_dir) / 'store.json') as f:
+            meta = json.load(f)
+        assert meta['version'] == STORE_VERSION, \
+            f"unsupported heatmap store version {meta['version']}"
+        self.index = pd.read_csv(Path(store_dir) / 'index.csv',
+                                 dtype={'img_id': str, 'task': str},
+                                 keep_default_na=False,
+                                 float_precision='round_trip')
+        self.maps = np.memmap(Path(store_dir) / 'maps.bin',
+                              dtype=meta['dtype'], mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def records(self):
+        """Return a reference to every heatmap in the store."""
+        return [StoredHeatmap(self.store_dir, row, img_id, task)
+                for row, (img_id, task) in
+                enumerate(zip(self.index['img_id'], self.index['task']))]
+
+    def load(self, row):
+        """Return the heatmap at `row` in the same layout as a pickle file."""
+        entry = self.index.iloc[row]
+        offset, height, width = entry['offset'], entry['height'], entry['width']
+        saliency_map = np.array(self.maps[offset:offset + height * width],
+                                dtype=np.float32)
+        return {'map': torch.from_numpy(saliency_map).view(1, 1, height, width),
+                'prob': float(entry['prob']),
+                'task': entry['task'],
+                'cxr_dims': (int(entry['cxr_width']), int(entry['cxr_height']))}
+
+
+@lru_cache(maxsize=None)
+def open_store(store_dir):
+    """Open a store once per process."""
+    return HeatmapStore(store_dir)
+
+
+def is_heatmap_store(map_dir):
+    """Return True if `map_dir` is a heatmap store rather than pickle files."""
+    return (Path(map_dir) / 'store.json').is_file()
+
+
+def list_heatmaps(map_dir, task=None):
+    """
+    List the heatmaps of a directory of pickle files or of a store, sorted by
+    path.
+
+    Args:
+        map_dir (str): directory with pickle files or heatmap store
+        task (str): if given, only list heatmaps of this pathology
+    """
+    pattern = f'*{task}_map.pkl' if task else '*_map.pkl'
+    if is_heatmap_store(map_dir):
+        records = open_store(str(map_dir)).records()
+        return sorted(r for r in records if fnmatch.fnmatch(r.name, pattern))
+    return sorted(Path(map_dir).rglob(pattern))
+
+
+def read_heatmap(pkl_path):
+    """
+    Load a heatmap given a pickle file path or a `StoredHeatmap`.
+
+    Returns:
+        info (dict): with keys 'map', 'prob', 'task' and 'cxr_dims'
+    """
+    if isinstance(pkl_path, StoredHeatmap):
+        return open_store(pkl_path.store_dir).load(pkl_path.row)
+    with open(pkl_path, 'rb') as f:
+        return CPU_Unpickler(f).load()
+
+
+def convert(map_dir, output_dir, dtype='float32'):
+    """
+    Pack all heatmap pickle files in `map_dir` into a store in `output_dir`.
+
+    Args:
+        map_dir (str): directory with pickle files containing heatmaps
+        output_dir (str): where to write the store
+        dtype (str): dtype of the stored maps, float32 or float16
+    """
+    assert dtype in ['float32', 'float16'], \
+        "`dtype` must be either `float32` or `float16`"
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    records = []
+    offset = 0
+    with open(output_dir / 'maps.bin', 'wb') as maps_file:
+        for pkl_path in tqdm(sorted(Path(map_dir).rglob('*_map.pkl'))):
+            task, img_id = parse_pkl_filename(pkl_path)
+            info = read_heatmap(pkl_path)
+
+            saliency_map = info['map'].squeeze().detach().cpu().numpy()
+            assert saliency_map.ndim == 2
+            maps_file.write(saliency_map.astype(dtype).tobytes())
+
+            if torch.is_tensor(info['prob']) and info['prob'].size()[0] == 14:
+                prob_idx = CHEXPERT_TASKS.index(info['task'])
+                pred_prob = info['prob'][prob_idx].item()
+            else:
+                pred_prob = float(info['prob'])
+
+            records.append({'img_id': img_id,
+                            'task': task,
+                            'offset': offset,
+                            'height': saliency_map.shape[0],
+                            'width': saliency_map.shape[1],
+                            'cxr_width': info['cxr_dims'][0],
+                            'cxr_height': info['cxr_dims'][1],
+                            'prob': pred_prob})
+            offset += saliency_map.size
+
+    index = pd.DataFrame.from_records(
+        records, columns=['img_id', 'task', 'offset', 'height', 'width',
+                          'cxr_width', 'cxr_height', 'prob'])
+    index.to_csv(output_dir / 'index.csv', index=False)
+    with open(output_dir / 'store.json', 'w') as f:
+        json.dump({'version': STORE_VERSION, 'dtype': dtype}, f)
+    print(f'Packed {len(records)} heatmaps into {output_dir}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--map_dir', type=str,
+                        help='directory with pickle files containing heatmaps')
+    parser.add_argument('--output_dir', type=str,
+                        help='directory where the heatmap store is saved')
+    parser.add_argument('--dtype', type=str, default='float32',
+                        help='dtype of the stored maps: float32 (lossless) or \
+                              float16 (half the size, lossy)')
+    args = parser.parse_args()
+
+    convert(args.map_dir, args.output_dir, args.dtype)
@@ -11,50 +11,135 @@ provided file sample/tuning_results.csv.
 """
 from argparse import ArgumentParser
 import cv2
-import json
+from itertools import chain
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 import os
 from pathlib import Path
 import pickle
-from PIL import Image, ImageDraw
 import sys
 import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 
 from eval_constants import CHEXPERT_TASKS, LOCALIZATION_TASKS
-from utils import CPU_Unpickler, encode_segmentation, parse_pkl_filename
+from heatmap_store import list_heatmaps, read_heatmap
+from lazy_heatmap import LazyHeatmap
+from segmentation_cache import SegmentationCache
+from segmentation_json import SegmentationWriter
+from utils import (CPU_Unpickler, encode_segmentation, parse_pkl_filename,
+                   rle_area)
 
 
-def cam_to_segmentation(cam_mask, threshold=np.nan, smoothing=False, k=0):
+class ThresholdPolicy:
+    """
+    Per-pathology parameters used to convert heatmaps to segmentations: the
+    heatmap threshold (NaN selects Otsu's method), the probability cutoff
+    below which a segmentation is forced to all zeros, and box-filter
+    smoothing. Threshold csv files are resolved once, up front.
+
+    Args:
+        thresholds (dict): {task: heatmap threshold}; if None, every task uses
+                           Otsu's method
+        prob_cutoffs (dict): {task: probability cutoff}; if None, no cutoff
+                             is applied
+        smoothing (bool): if true, smooth the heatmaps using box filtering
+        k (int): size of kernel used for box filter smoothing
+    """
+    def __init__(self, thresholds=None, prob_cutoffs=None, smoothing=False,
+                 k=0):
+        self.thresholds = thresholds
+        self.prob_cutoffs = prob_cutoffs
+        self.smoothing = smoothing
+        self.k = k
+
+    @classmethod
+    def from_csv(cls, threshold_path=None, probability_threshold_path=None,
+                 smoothing=False, k=0):
+        """
+        Build a policy from the outputs of the tuning scripts.
+
+        Args:
+            threshold_path (str): csv file with a threshold per task (see
+                                  tune_heatmap_threshold.py)
+            probability_threshold_path (str): csv file with the mIoU of each
+                                              probability cutoff per task (see
+                                              tune_probability_threshold.py);
+                                              the cutoff with max mIoU is used
+        """
+        thresholds = None
+        if threshold_path:
+            tuning_results = pd.read_csv(threshold_path)
+            tuning_results = tuning_results.drop_duplicates('task')
+            thresholds = dict(zip(tuning_results['task'].to_numpy(),
+                                  tuning_results['threshold'].to_numpy()))
+
+        prob_cutoffs = None
+        if probability_threshold_path:
+            prob_results = pd.read_csv(probability_threshold_path)
+            max_miou = prob_results.loc[prob_results.groupby(['task'])['mIoU'].\
+                                                     agg('idxmax')]
+            prob_cutoffs = dict(zip(max_miou['task'].to_numpy(),
+                                    max_miou['prob_threshold'].to_numpy()))
+
+        return cls(thresholds, prob_cutoffs, smoothing, k)
+
+    def threshold(self, task):
+        """Return the heatmap threshold for `task` (NaN for Otsu's method)."""
+        if self.thresholds is None:
+            return np.nan
+        return self.thresholds[task]
+
+    def prob_cutoff(self, task):
+        """Return the probability cutoff for `task`."""
+        if self.prob_cutoffs is None:
+            return 0
+        return self.prob_cutoffs[task]
+
+    def params(self, task):
+        """Return the keyword arguments of `pkl_to_mask` for `task`."""
+        return {'threshold': self.threshold(task),
+                'prob_cutoff': self.prob_cutoff(task),
+                'smoothing': self.smoothing,
+                'k': self.k}
+
+
+def cam_to_segmentation(cam_mask, threshold=np.nan, smoothing=False, k=0,
+                        out=None, normalized=False):
     """
     Threshold a saliency heatmap to binary segmentation mask.
     Args:
-        cam_mask (torch.Tensor): heat map in the original image size (H x W).
-            Will squeeze the tensor if there are more than two dimensions.
+        cam_mask (torch.Tensor or LazyHeatmap): heat map in the original image
+            size (H x W). Will squeeze the tensor if there are more than two
+            dimensions. A LazyHeatmap is never materialized in float.
         threshold (np.float64): threshold to use
         smoothing (bool): if true, smooth the pixelated heatmaps using box filtering
         k (int): size of kernel used for box filter smoothing (int); k must be
                  >= 0; if k is > 0, make sure to set if_smoothing to True,
                  otherwise no smoothing would be performed.
+        out (np.ndarray): optional [H x W] uint8 array, preferably in Fortran
+                          order, to write the segmentation into
+        normalized (bool): if true, cam_mask is an [H x W] np.ndarray already
+                           min-max normalized (see `normalize_heatmaps`),
+                           which may be modified
 
     Returns:
-        segmentation (np.ndarray): binary segmentation output
+        segmentation (np.ndarray): binary segmentation output (uint8)
     """
-    if (len(cam_mask.size()) > 2):
-        cam_mask = cam_mask.squeeze()
-
-    assert len(cam_mask.size()) == 2
-
-    # normalize heatmap
-    mask = cam_mask - cam_mask.min()
-    mask = mask.div(mask.max()).data
-    mask = mask.cpu().detach().numpy()
+    lazy = isinstance(cam_mask, LazyHeatmap)
+    if normalized:
+        mask = cam_mask
+    elif not lazy:
+        mask = normalize_heatmap(cam_mask)
 
     # use Otsu's method to find threshold if no threshold is passed in
     if np.isnan(threshold):
-        mask = np.uint8(255 * mask)
+        if lazy:
+            mask = cam_mask.to_uint8()
+        else:
+            mask *= 255
+            mask = mask.astype(np.uint8)
 
         if smoothing:
             heatmap = cv2.applyColorMap(mask, cv2.COLORMAP_JET)
@@ -65,134 +150,375 @@ def cam_to_segmentation(cam_mask, threshold=np.nan, smoothing=False, k=0):
         maxval = np.max(mask)
         thresh = cv2.threshold(mask, 0, maxval, cv2.THRESH_OTSU)[1]
 
-        # draw out contours
-        cnts = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        # fill the contours: filling every outer contour covers the holes
+        # and nested contours that were drawn one by one as polygons
+        cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_SIMPLE)
         cnts = cnts[0] if len(cnts) == 2 else cnts[1]
-        polygons = []
-        for cnt in cnts:
-            if len(cnt) > 1:
-                polygons.append([list(pt[0]) for pt in cnt])
+        cnts = [cnt for cnt in cnts if len(cnt) > 1]
 
         # create segmentation based on contour
-        img_dims = (mask.shape[1], mask.shape[0])
-        segmentation_output = Image.new('1', img_dims)
-        for polygon in polygons:
-            coords = [(point[0], point[1]) for point in polygon]
-            ImageDraw.Draw(segmentation_output).polygon(coords,
-                                                        outline=1,
-                                                        fill=1)
-        segmentation = np.array(segmentation_output, dtype="int")
+        segmentation = np.zeros(mask.shape, dtype=np.uint8)
+        cv2.drawContours(segmentation, cnts, -1, 1, thickness=cv2.FILLED)
+        if out is not None:
+            out[...] = segmentation
+            segmentation = out
+    elif lazy:
+        segmentation = cam_mask.threshold(threshold, out=out)
     else:
-        segmentation = np.array(mask > threshold, dtype="int")
+        if out is None:
+            out = np.empty(mask.shape, dtype=np.uint8, order='F')
+        segmentation = np.greater(mask, threshold, out=out)
 
     return segmentation
 
 
-def pkl_to_mask(pkl_path, threshold=np.nan, prob_cutoff=0,
-                smoothing=False, k=0):
+def normalize_heatmap(cam_mask):
+    """
+    Min-max normalize a saliency heatmap to [0, 1].
+
+    Args:
+        cam_mask (torch.Tensor): heat map in the original image size (H x W).
+            Will squeeze the tensor if there are more than two dimensions.
+
+    Returns:
+        heatmap (np.ndarray): normalized [H x W] heatmap
+    """
+    if (len(cam_mask.size()) > 2):
+        cam_mask = cam_mask.squeeze()
+
+    assert len(cam_mask.size()) == 2
+
+    mask = cam_mask - cam_mask.min()
+    mask = mask.div_(mask.max()).data
+    return mask.cpu().detach().numpy()
+
+
+def normalize_heatmaps(cam_masks):
+    """
+    Min-max normalize a batch of saliency heatmaps to [0, 1] in place, each
+    with its own min and max, as `normalize_heatmap` does for one heatmap.
+
+    Args:
+        cam_masks (torch.Tensor): [B x 1 x H x W] heatmaps
+
+    Returns:
+        heatmaps (np.ndarray): normalized [B x H x W] heatmaps
+    """
+    cam_masks -= cam_masks.amin(dim=(2, 3), keepdim=True)
+    cam_masks /= cam_masks.amax(dim=(2, 3), keepdim=True)
+    return cam_masks.numpy()[:, 0]
+
+
+def load_heatmap(pkl_path, lazy=False):
     """
     Load pickle file, get saliency map and resize to original image dimension.
-    Threshold the heatmap to binary segmentation.
 
     Args:
-        pkl_path (str): path to the model output pickle file
-        threshold (np.float64): threshold to use
+        pkl_path (str or StoredHeatmap): path to the model output pickle
+                                         file, or heatmap in a store
+        lazy (bool): if true, return a LazyHeatmap that keeps the map at its
+                     native resolution instead of resizing it
 
     Returns:
-        segmentation (np.ndarray): binary segmentation output
+        map_resized (torch.Tensor or LazyHeatmap): [1 x 1 x H x W] saliency map
+        pred_prob (float): model probability for the task of the pickle file
     """
-    # load pickle file
-    info = CPU_Unpickler(open(pkl_path, 'rb')).load()
+    info = read_heatmap(pkl_path)
+    return resize_heatmap(info, lazy=lazy), heatmap_probability(info)
+
 
-    # get saliency map and resize
+def resize_heatmap(info, lazy=False):
+    """
+    Resize the saliency map of a loaded heatmap to the original image
+    dimension (see `load_heatmap`).
+    """
     saliency_map = info['map']
     img_dims = info['cxr_dims']
-    map_resized = F.interpolate(saliency_map,
-                                size=(img_dims[1], img_dims[0]),
-                                mode='bilinear',
-                                align_corners=False)
+    if lazy:
+        return LazyHeatmap(saliency_map, img_dims)
+    return F.interpolate(saliency_map, size=(img_dims[1], img_dims[0]),
+                         mode='bilinear', align_corners=False)
 
-    # if probability cutoffs are given, then if the cxr has a predicted
-    # probability that is lower than the cutoff, force the predicted
-    # segmentation mask to be all zeros.
+
+def heatmap_probability(info):
+    """Return the model probability for the task of a loaded heatmap."""
     if torch.is_tensor(info['prob']) and info['prob'].size()[0] == 14:
         prob_idx = CHEXPERT_TASKS.index(info['task'])
-        pred_prob = info['prob'][prob_idx].item()
-    else:
-        pred_prob = info['prob']
+        return info['prob'][prob_idx].item()
+    return info['prob']
+
+
+# per-process buffer reused by consecutive segmentations of the same size
+_scratch = None
+
 
-    if pred_prob < prob_cutoff:
-        segmentation = np.zeros((img_dims[1], img_dims[0]))
+def _scratch_buffer(shape):
+    """Return a Fortran-ordered uint8 buffer of `shape`, reused if possible."""
+    global _scratch
+    if _scratch is None or _scratch.shape != shape:
+        _scratch = np.empty(shape, dtype=np.uint8, order='F')
+    return _scratch
+
+
+def pkl_to_mask(pkl_path, threshold=np.nan, prob_cutoff=0,
+                smoothing=False, k=0, lazy=False, reuse_buffer=False):
+    """
+    Load pickle file, get saliency map and resize to original image dimension.
+    Threshold the heatmap to binary segmentation.
+
+    Args:
+        pkl_path (str or dict): path to the model output pickle file, or
+                                heatmap already loaded with `read_heatmap`
+        threshold (np.float64): threshold to use
+        lazy (bool): if true, upsample the heatmap band by band instead of
+                     materializing it at full resolution (see lazy_heatmap.py)
+        reuse_buffer (bool): if true, write the segmentation into a buffer
+                             of this process that the next call of the same
+                             size overwrites, instead of allocating one
+
+    Returns:
+        segmentation (np.ndarray): binary segmentation output (uint8, Fortran
+                                   order)
+    """
+    info = pkl_path if isinstance(pkl_path, dict) else read_heatmap(pkl_path)
+    img_dims = info['cxr_dims']
+
+    # if probability cutoffs are given, then if the cxr has a predicted
+    # probability that is lower than the cutoff, force the predicted
+    # segmentation mask to be all zeros. The heatmap is not resized then.
+    if heatmap_probability(info) < prob_cutoff:
+        segmentation = np.zeros((img_dims[1], img_dims[0]), dtype=np.uint8,
+                                order='F')
     else:
         # convert to segmentation
-        segmentation = cam_to_segmentation(map_resized, threshold=threshold,
-                                           smoothing=smoothing, k=k)
+        out = None
+        if reuse_buffer:
+            out = _scratch_buffer((img_dims[1], img_dims[0]))
+        segmentation = cam_to_segmentation(resize_heatmap(info, lazy=lazy),
+                                           threshold=threshold,
+                                           smoothing=smoothing, k=k, out=out)
     return segmentation
 
 
+def pkls_to_masks(pkl_paths, params, reuse_buffer=False):
+    """
+    Segment many heatmaps as `pkl_to_mask` does, resizing and normalizing
+    the heatmaps that share CXR dimensions (and native size) in one batch.
+
+    Args:
+        pkl_paths (list): paths to model output pickle files (or heatmaps in
+                          a store, or heatmaps already loaded)
+        params (list): keyword arguments of `pkl_to_mask` for each heatmap
+                       (`lazy` is ignored)
+        reuse_buffer (bool): see `pkl_to_mask`; each segmentation must then be
+                             used before the next one is yielded
+
+    Yields:
+        segmentation (np.ndarray): binary segmentation output (uint8, Fortran
+                                   order) of each heatmap, in order
+    """
+    infos = [pkl_path if isinstance(pkl_path, dict) else read_heatmap(pkl_path)
+             for pkl_path in pkl_paths]
+
+    # heatmaps below their probability cutoff are not resized
+    batches = {}
+    for i, (info, job_params) in enumerate(zip(infos, params)):
+        if heatmap_probability(info) >= job_params['prob_cutoff']:
+            key = (tuple(info['cxr_dims']), tuple(info['map'].shape[-2:]),
+                   info['map'].dtype)
+            batches.setdefault(key, []).append(i)
+
+    normalized = {}
+    with torch.inference_mode():
+        for (img_dims, map_size, _), batch in batches.items():
+            maps = torch.cat([infos[i]['map'].reshape(1, 1, *map_size)
+                              for i in batch])
+            maps = F.interpolate(maps, size=(img_dims[1], img_dims[0]),
+                                 mode='bilinear', align_corners=False)
+            normalized.update(zip(batch, normalize_heatmaps(maps)))
+
+    for i, (info, job_params) in enumerate(zip(infos, params)):
+        h, w = info['cxr_dims'][1], info['cxr_dims'][0]
+        if i not in normalized:
+            yield np.zeros((h, w), dtype=np.uint8, order='F')
+            continue
+        out = _scratch_buffer((h, w)) if reuse_buffer else None
+        yield cam_to_segmentation(normalized.pop(i),
+                                  threshold=job_params['threshold'],
+                                  smoothing=job_params['smoothing'],
+                                  k=job_params['k'], out=out,
+                                  normalized=True)
+
+
+def _init_worker(num_threads=1):
+    # each worker process gets one core by default; parallelism comes from
+    # the pool
+    torch.set_num_threads(num_threads)
+
+
+def _entry(info, rle):
+    return {'rle': rle, 'area': rle_area(rle),
+            'prob': float(heatmap_probability(info))}
+
+
+def encode_heatmap(pkl_path, params, cache=None, reuse_buffer=False):
+    """
+    Segment a heatmap as `pkl_to_mask` does and encode the segmentation, or
+    read it from a cache.
+
+    Args:
+        pkl_path (str): path to the model output pickle file (or heatmap in a
+                        store)
+        params (dict): keyword arguments of `pkl_to_mask`
+        cache (SegmentationCache): if given, cache of derived segmentations
+                                   (see segmentation_cache.py)
+        reuse_buffer (bool): see `pkl_to_mask`
+
+    Returns:
+        entry (dict): {'rle': encoded segmentation, 'area': its area,
+                       'prob': model probability of the heatmap}
+    """
+    if cache is not None:
+        key = cache.key(pkl_path, **params)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+
+    info = read_heatmap(pkl_path)
+    segmentation = pkl_to_mask(info, reuse_buffer=reuse_buffer, **params)
+    entry = _entry(info, encode_segmentation(segmentation))
+    if cache is not None:
+        cache.put(key, entry)
+    return entry
+
+
+def _encode_heatmap(job):
+    """Segment one heatmap and return its RLE, keyed by task and image id."""
+    pkl_path, params, cache = job
+    task, img_id = parse_pkl_filename(pkl_path)
+    # the mask is encoded right away, so its buffer can be reused
+    entry = encode_heatmap(pkl_path, params, cache, reuse_buffer=True)
+    return task, img_id, entry['rle']
+
+
+def _encode_heatmap_batch(jobs):
+    """Segment a batch of heatmaps and return their RLEs (see above)."""
+    cache = jobs[0][2]
+
+    entries, keys, misses = [None] * len(jobs), [None] * len(jobs), []
+    for i, (pkl_path, params, _) in enumerate(jobs):
+        if cache is not None:
+            keys[i] = cache.key(pkl_path, **params)
+            entries[i] = cache.get(keys[i])
+        if entries[i] is None:
+            misses.append(i)
+
+    # only heatmaps missing from the cache are loaded and segmented
+    infos = [read_heatmap(jobs[i][0]) for i in misses]
+    segmentations = pkls_to_masks(infos, [jobs[i][1] for i in misses],
+                                  reuse_buffer=True)
+    for i, info, segmentation in zip(misses, infos, segmentations):
+        entries[i] = _entry(info, encode_segmentation(segmentation))
+        if cache is not None:
+            cache.put(keys[i], entries[i])
+
+    encoded = []
+    for (pkl_path, _, _), entry in zip(jobs, entries):
+        task, img_id = parse_pkl_filename(pkl_path)
+        encoded.append((task, img_id, entry['rle']))
+    return encoded
+
+
 def heatmap_to_mask(args):
     """
     Converts all saliency maps to segmentations and stores segmentations in a
     json file.
+
+    With `args.workers` > 1, heatmaps are segmented and encoded in a process
+    pool. Workers return RLE dicts which are written in the sorted order of the
+    pickle paths, so the output does not depend on scheduling. Segmentations
+    are written as they are produced, grouped by CXR in order of first
+    appearance, instead of being collected in memory.
+
+    With `args.batch_size` > 1, consecutive heatmaps are segmented in batches
+    (see `pkls_to_masks`); heatmaps of a CXR share its dimensions, so a batch
+    of at least the number of tasks resizes every heatmap of a CXR at once.
+
+    With `args.cache_dir`, segmentations are read from and saved to a cache
+    (see segmentation_cache.py) of at most `args.cache_size_mb` MB, so a rerun
+    after changing the parameters of one task only recomputes that task.
     """
     print('Parsing saliency maps')
-    all_paths = list(Path(args.map_dir).rglob('*_map.pkl'))
+    all_paths = list_heatmaps(args.map_dir)
+
+    # resolve thresholds, probability cutoffs and smoothing once per task
+    policy = ThresholdPolicy.from_csv(args.threshold_path,
+                                      args.probability_threshold_path,
+                                      smoothing=eval(args.if_smoothing),
+                                      k=args.k)
+
+    lazy = eval(getattr(args, 'lazy_upsampling', 'False'))
+    cache_dir = getattr(args, 'cache_dir', None)
+    cache = None
+    if cache_dir:
+        cache = SegmentationCache(
+            cache_dir, getattr(args, 'cache_size_mb', 1024) << 20)
 
-    results = {}
-    for pkl_path in tqdm(all_paths):
+    jobs_per_cxr = {}
+    for pkl_path in all_paths:
         task, img_id = parse_pkl_filename(pkl_path)
         if task not in LOCALIZATION_TASKS:
             continue
+        params = policy.params(task)
+        params['lazy'] = lazy
+        jobs_per_cxr.setdefault(img_id, []).append((pkl_path, params, cache))
+    jobs = [job for cxr_jobs in jobs_per_cxr.values() for job in cxr_jobs]
 
-        # get encoded segmentation mask; check if self-defined thresholds are
-        # given to threshold heatmaps
-        if args.threshold_path:
-            tuning_results = pd.read_csv(args.threshold_path)
-            best_threshold = tuning_results[tuning_results['task'] ==
-                                            task]['threshold'].values[0]
-        else:
-            best_threshold = np.nan
+    workers = getattr(args, 'workers', 1)
+    num_threads = getattr(args, 'num_threads', None)
+    batch_size = getattr(args, 'batch_size', 1)
+    if batch_size > 1:
+        tasks = [jobs[i:i + batch_size]
+                 for i in range(0, len(jobs), batch_size)]
+        encode, chunksize = _encode_heatmap_batch, 1
+    else:
+        tasks, encode, chunksize = jobs, _encode_heatmap, 8
 
-        # check if probability cutoffs are given, in which case segmentation
-        # masks are all zeros
-        if args.probability_threshold_path:
-            prob_results = pd.read_csv(args.probability_threshold_path)
-            max_miou = prob_results.loc[prob_results.groupby(['task'])['mIoU'].\
-                                                     agg('idxmax')]
-            prob_cutoff = max_miou[max_miou['task'] ==
-                                   task]['prob_threshold'].values[0]
-        else:
-            prob_cutoff = 0
-
-        segmentation = pkl_to_mask(pkl_path,
-                                   threshold=best_threshold,
-                                   prob_cutoff=prob_cutoff,
-                                   smoothing=eval(args.if_smoothing),
-                                   k=args.k)
-        encoded_mask = encode_segmentation(segmentation)
-
-        # add image and segmentation to results dict
-        if img_id in results:
-            if task in results[img_id]:
-                print(f'Check for duplicates for {task} for {img_id}')
-                break
-            else:
-                results[img_id][task] = encoded_mask
-        else:
-            results[img_id] = {}
-            results[img_id][task] = encoded_mask
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_worker,
+                    initargs=(num_threads or 1,))
+        encoded = pool.imap(encode, tasks, chunksize=chunksize)
+    else:
+        pool = None
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        encoded = map(encode, tasks)
+    if batch_size > 1:
+        encoded = chain.from_iterable(encoded)
 
     # save to json
     Path(os.path.dirname(args.output_path)).mkdir(exist_ok=True, parents=True)
-    with open(args.output_path, 'w') as f:
-        json.dump(results, f)
+    written = set()
+    try:
+        with SegmentationWriter(args.output_path) as writer:
+            for task, img_id, encoded_mask in tqdm(encoded, total=len(jobs)):
+                if (img_id, task) in written:
+                    print(f'Check for duplicates for {task} for {img_id}')
+                    break
+                writer.write(img_id, task, encoded_mask)
+                written.add((img_id, task))
+    finally:
+        if pool is not None:
+            pool.terminate()
     print(f'Segmentation masks (in RLE format) saved to {args.output_path}')
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--map_dir', type=str,
-                        help='directory with pickle files containing heatmaps')
+                        help='directory with pickle files containing heatmaps, \
+                              or heatmap store (see heatmap_store.py)')
     parser.add_argument('--threshold_path', type=str,
                         help="csv file that stores pre-defined threshold values. \
                         If no path is given, script uses Otsu's.")
@@ -212,8 +538,36 @@ if __name__ == '__main__':
                               k must be >= 0; if k is > 0, make sure to set \
                               if_smoothing to True, otherwise no smoothing would \
                               be performed.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used to convert heatmaps; \
+                              1 converts them in the main process')
+    parser.add_argument('--lazy_upsampling', type=str, default='False',
+                        help='If true, upsample each heatmap band by band at \
+                              its native resolution instead of materializing \
+                              it at full CXR size, to reduce peak memory.')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='number of consecutive heatmaps segmented at a \
+                              time; heatmaps of a batch with the same CXR \
+                              dimensions are resized in a single call. 1 \
+                              segments heatmaps one by one.')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='directory of a cache of derived segmentations \
+                              (see segmentation_cache.py); heatmaps whose \
+                              segmentation with the same parameters is \
+                              cached are not recomputed')
+    parser.add_argument('--cache_size_mb', type=int, default=1024,
+                        help='maximum size of the cache (MB) before least \
+                              recently used segmentations are evicted')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='number of threads used by torch in each process \
+                              (defaults to 1 per worker with --workers > 1, \
+                              and to the torch default otherwise)')
     args = parser.parse_args()
     assert args.if_smoothing in ['True', 'False'], \
         "`if_smoothing` flag must be either `True` or `False`"
+    assert args.lazy_upsampling in ['True', 'False'], \
+        "`lazy_upsampling` flag must be either `True` or `False`"
+    assert args.batch_size == 1 or args.lazy_upsampling == 'False', \
+        "`batch_size` > 1 cannot be combined with `lazy_upsampling`"
 
     heatmap_to_mask(args)
@@ -0,0 +1,212 @@
+"""
+Saliency heatmaps kept at their native (low) resolution, with values of the
+full-resolution map computed on demand, a band of rows at a time.
+
+Scripts upsample every heatmap to the CXR size with
+`F.interpolate(mode='bilinear', align_corners=False)` before thresholding it,
+which costs a float32 copy of the whole CXR (~25 MB for 2800x2300) plus
+temporaries of the same size. `LazyHeatmap` reproduces the same bilinear
+values band by band, so peak memory is one uint8 mask plus a few bands.
+
+Tolerance: the bands follow the arithmetic of PyTorch's CPU kernel (float32
+source indices and weights, fused multiply-adds), and match `F.interpolate`
+bit for bit on FMA-capable CPUs. Other builds may differ by 1 ulp on some
+pixels, which can only flip pixels whose normalized value lies within 1 ulp of
+the threshold. PyTorch rounds differently for tiny outputs, which are cheap
+to upsample anyway, so those are upsampled with `F.interpolate` directly.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# number of full-resolution rows computed at a time
+BAND_ROWS = 256
+# outputs up to this many pixels are upsampled with F.interpolate
+SMALL_OUTPUT_PIXELS = 65536
+
+
+def _fma(a, b, c):
+    """Fused float32 multiply-add a * b + c, emulated in float64."""
+    out = np.multiply(a, b, dtype=np.float64)
+    out += c
+    return out.astype(np.float32)
+
+
+def _linear_indices_weights(input_size, output_size):
+    """
+    Source indices and weights of 1D linear interpolation with
+    align_corners=False, as computed by PyTorch.
+    """
+    if input_size == output_size:
+        idx = np.arange(output_size)
+        return (idx, idx, np.ones(output_size, dtype=np.float32),
+                np.zeros(output_size, dtype=np.float32))
+
+    scale = np.float32(input_size) / np.float32(output_size)
+    src = _fma(scale, np.arange(output_size, dtype=np.float32) + 0.5, -0.5)
+    src = np.maximum(src, np.float32(0))
+    idx0 = np.minimum(np.floor(src).astype(np.int64), input_size - 1)
+    idx1 = idx0 + (idx0 < input_size - 1)
+    lambda1 = np.clip(src - idx0.astype(np.float32), 0, 1).astype(np.float32)
+    lambda0 = np.float32(1) - lambda1
+    return idx0, idx1, lambda0, lambda1
+
+
+def _groups(idx0, idx1):
+    """
+    Split output indices into runs [start, stop) that interpolate between the
+    same two source indices. Returns the runs and their source indices.
+    """
+    change = np.flatnonzero((np.diff(idx0) != 0) | (np.diff(idx1) != 0)) + 1
+    starts = np.concatenate([[0], change])
+    stops = np.concatenate([change, [len(idx0)]])
+    return starts, stops, idx0[starts], idx1[starts]
+
+
+class LazyHeatmap:
+    """
+    Saliency map at native resolution whose bilinear upsampling to the CXR
+    size is evaluated lazily.
+
+    Args:
+        saliency_map (torch.Tensor or np.ndarray): [(1 x 1 x) h x w] heatmap
+        img_dims (tuple): original CXR dimensions (w, h)
+    """
+    def __init__(self, saliency_map, img_dims):
+        if torch.is_tensor(saliency_map):
+            saliency_map = saliency_map.detach().cpu().numpy()
+        saliency_map = np.asarray(saliency_map, dtype=np.float32)
+        saliency_map = saliency_map.reshape(saliency_map.shape[-2:])
+
+        self.saliency_map = saliency_map
+        self.shape = (img_dims[1], img_dims[0])
+        self.row_idx0, self.row_idx1, self.row_w0, self.row_w1 = \
+            _linear_indices_weights(saliency_map.shape[0], self.shape[0])
+        col_idx0, col_idx1, col_w0, col_w1 = \
+            _linear_indices_weights(saliency_map.shape[1], self.shape[1])
+
+        # every output row mixes two of these horizontally upsampled rows
+        self.upsampled_rows = _fma(saliency_map[:, col_idx0], col_w0,
+                                   saliency_map[:, col_idx1] * col_w1)
+        self._value_range = None
+
+        self._small = None
+        if self.shape[0] * self.shape[1] <= SMALL_OUTPUT_PIXELS:
+            self._small = F.interpolate(
+                torch.from_numpy(saliency_map)[None, None], size=self.shape,
+                mode='bilinear', align_corners=False).numpy()[0, 0]
+
+    def rows(self, start, stop):
+        """Return rows [start, stop) of the upsampled heatmap."""
+        if self._small is not None:
+            return self._small[start:stop].copy()
+        w0 = self.row_w0[start:stop, None]
+        w1 = self.row_w1[start:stop, None]
+        return _fma(self.upsampled_rows[self.row_idx0[start:stop]], w0,
+                    self.upsampled_rows[self.row_idx1[start:stop]] * w1)
+
+    def region(self, row_start, row_stop, col_start, col_stop):
+        """Return the block [row_start, row_stop) x [col_start, col_stop)."""
+        if self._small is not None:
+            return self._small[row_start:row_stop, col_start:col_stop].copy()
+        w0 = self.row_w0[row_start:row_stop, None]
+        w1 = self.row_w1[row_start:row_stop, None]
+        upsampled_rows = self.upsampled_rows[:, col_start:col_stop]
+        return _fma(upsampled_rows[self.row_idx0[row_start:row_stop]], w0,
+                    upsampled_rows[self.row_idx1[row_start:row_stop]] * w1)
+
+    def argmax(self):
+        """
+        Return the (row, column) of the maximum of the upsampled heatmap, as
+        `np.unravel_index(np.argmax(...))` would, without upsampling all of it.
+
+        Each output pixel is a convex combination of the 2 x 2 source pixels
+        of its block, so a block can only hold the maximum if its largest
+        corner (plus rounding slack) reaches a value already attained. The
+        first and last row of every block are evaluated to find such a
+        value, and then only the blocks that can still beat it.
+        """
+        row_starts, row_stops, row_src0, row_src1 = _groups(self.row_idx0,
+                                                            self.row_idx1)
+        col_starts, col_stops, col_src0, col_src1 = _groups(
+            *_linear_indices_weights(self.saliency_map.shape[1],
+                                     self.shape[1])[:2])
+
+        # a value attained by the upsampled heatmap
+        edge_rows = np.unique(np.concatenate([row_starts, row_stops - 1]))
+        attained = max(self.rows(r, r + 1).max() for r in edge_rows)
+
+        # upper bound of every block: its largest corner plus rounding slack
+        corners = np.stack([self.saliency_map[np.ix_(rows, cols)]
+                            for rows in (row_src0, row_src1)
+                            for cols in (col_src0, col_src1)])
+        slack = 4 * np.finfo(np.float32).eps * np.abs(corners).max(axis=0)
+        bound = corners.max(axis=0) + slack
+
+        best, best_pos = -np.inf, None
+        for i, j in zip(*np.nonzero(bound >= attained)):
+            block = self.region(row_starts[i], row_stops[i],
+                                col_starts[j], col_stops[j])
+            r, c = np.unravel_index(np.argmax(block), block.shape)
+            pos = (int(row_starts[i] + r), int(col_starts[j] + c))
+            # np.argmax keeps the first maximum in row-major order
+            if block[r, c] > best or (block[r, c] == best and pos < best_pos):
+                best, best_pos = block[r, c], pos
+
+        if best_pos is None:
+            # maps with NaNs: fall back to the full upsampled heatmap
+            full = self.to_tensor().numpy().squeeze()
+            best_pos = tuple(int(i) for i in
+                             np.unravel_index(np.argmax(full), full.shape))
+        return best_pos
+
+    def bands(self, band_rows=BAND_ROWS):
+        """Yield (start row, rows) bands covering the upsampled heatmap."""
+        for start in range(0, self.shape[0], band_rows):
+            yield start, self.rows(start, min(start + band_rows,
+                                              self.shape[0]))
+
+    def value_range(self):
+        """Return the min and max of the upsampled heatmap."""
+        if self._value_range is None:
+            lows, highs = zip(*[(band.min(), band.max())
+                                for _, band in self.bands()])
+            self._value_range = (min(lows), max(highs))
+        return self._value_range
+
+    def normalized_bands(self, band_rows=BAND_ROWS):
+        """
+        Yield (start row, rows) bands of the upsampled heatmap min-max
+        normalized to [0, 1], as `normalize_heatmap` computes it.
+        """
+        low, high = self.value_range()
+        scale = np.float32(high) - np.float32(low)
+        for start, band in self.bands(band_rows):
+            band -= low
+            with np.errstate(invalid='ignore', divide='ignore'):
+                band /= scale
+            yield start, band
+
+    def to_uint8(self):
+        """Return `np.uint8(255 * normalized heatmap)` at full resolution."""
+        image = np.empty(self.shape, dtype=np.uint8)
+        for start, band in self.normalized_bands():
+            with np.errstate(invalid='ignore'):
+                image[start:start + len(band)] = 255 * band
+        return image
+
+    def threshold(self, threshold, out=None):
+        """
+        Return the uint8 mask `normalized heatmap > threshold`, written into
+        `out` if given.
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=np.uint8, order='F')
+        for start, band in self.normalized_bands():
+            np.greater(band, threshold, out=out[start:start + len(band)])
+        return out
+
+    def to_tensor(self):
+        """Materialize the upsampled heatmap as a [1 x 1 x H x W] tensor."""
+        full = np.concatenate([band for _, band in self.bands()])
+        return torch.from_numpy(full)[None, None]
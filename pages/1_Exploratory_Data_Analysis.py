@@ -3,6 +3,7 @@ import json
 import os
 import pandas as pd
 import io
+import shutil
 import tempfile
 from pycocotools import mask
 import sys
@@ -65,17 +66,21 @@ if seg_path is not None:
 
                 output_csv_path = os.path.join(save_dir, "n_segs.csv")
                 df = pd.read_csv(output_csv_path)
+                area_df = pd.read_csv(os.path.join(
+                    save_dir, "seg_area_distribution.csv"))
 
                 # Save df in session state
                 st.session_state["df"] = df
+                st.session_state["area_df"] = area_df
 
                 # Clean up temp dir
-                os.remove(seg_file_path)
-                os.remove(output_csv_path)
-                os.rmdir(save_dir)
+                shutil.rmtree(save_dir)
 
         if "df" in st.session_state:
             st.dataframe(st.session_state["df"])
+        if "area_df" in st.session_state:
+            st.markdown("Segmentation areas (pixels)")
+            st.dataframe(st.session_state["area_df"])
 
 # Output CSV data
 output = io.BytesIO()
@@ -1,57 +1,99 @@
 from argparse import ArgumentParser
-import json
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from pycocotools import mask
 from tqdm import tqdm
 
 from eval_constants import LOCALIZATION_TASKS
+from ground_truth import GroundTruthIndex
 from heatmap_to_segmentation import pkl_to_mask
+from segmentation_json import iter_segmentations
+from utils import rle_area, rle_intersection_area
 
 
-def get_results(gt_dict, seg_path):
+def confusion_counts(seg_item, gt_item, gt_area):
+    """
+    Count the TP, TN, FP and FN pixels of one CXR from the areas of the
+    encoded segmentations and of their intersection, without decoding them.
+
+    Args:
+        seg_item (dict): segmentation in RLE format; None for an all-zero mask
+        gt_item (dict): ground-truth segmentation in RLE format
+        gt_area (int): number of foreground pixels of the ground truth
+    """
+    h, w = gt_item['size']
+    if seg_item is None:
+        seg_area = 0
+    else:
+        assert list(seg_item['size']) == list(gt_item['size'])
+        seg_area = rle_area(seg_item)
+
+    if seg_area == 0 or gt_area == 0:
+        intersection = 0
+    else:
+        intersection = rle_intersection_area(seg_item, gt_item)
+    return counts_from_areas(seg_area, gt_area, intersection, h * w)
+
+
+def counts_from_areas(seg_area, gt_area, intersection, num_pixels):
+    """
+    Return the (TP, TN, FP, FN) pixel counts of a CXR with `num_pixels` pixels
+    given the areas of both segmentations and of their intersection.
+    """
+    TP = intersection
+    FP = seg_area - intersection
+    FN = gt_area - intersection
+    TN = num_pixels - seg_area - gt_area + intersection
+    return TP, TN, FP, FN
+
+
+def get_results(gt, seg_path):
     """
     For each pathology, count the total number of pixels that are TP, TN, FP
     and FN. Only include CXRs that have ground-truth segmentations.
-    """
-    with open(seg_path) as f:
-        seg_dict = json.load(f)
 
-    results = {}
-    all_ids = sorted(gt_dict.keys())
-    tasks = sorted(LOCALIZATION_TASKS)
+    Segmentations in `seg_path` are read one at a time; (CXR, pathology)
+    pairs without one count as all-zero segmentations. Counts are computed
+    from RLE areas, so no mask is decoded.
 
-    for task in tqdm(tasks):
-        for img_id in all_ids:
-            gt_item = gt_dict[img_id][task]
-            gt_mask = mask.decode(gt_item)
-
-            if img_id not in seg_dict:
-                seg_mask = np.zeros(gt_mask.shape)
-            else:
-                seg_item = seg_dict[img_id][task]
-                seg_mask = mask.decode(seg_item)
-
-            TP = np.sum(np.logical_and(seg_mask == 1, gt_mask == 1))
-            TN = np.sum(np.logical_and(seg_mask == 0, gt_mask == 0))
-            FP = np.sum(np.logical_and(seg_mask == 1, gt_mask == 0))
-            FN = np.sum(np.logical_and(seg_mask == 0, gt_mask == 1))
-
-            if task in results:
-                results[task]['tp'] += TP
-                results[task]['tn'] += TN
-                results[task]['fp'] += FP
-                results[task]['fn'] += FN
-            else:
-                results[task] = {}
-                results[task]['tp'] = TP
-                results[task]['tn'] = TN
-                results[task]['fp'] = FP
-                results[task]['fn'] = FN
+    Args:
+        gt (dict or GroundTruthIndex): ground-truth segmentations
+        seg_path (str): json file or container with segmentations
+    """
+    gt = GroundTruthIndex.load(gt)
+    tasks = sorted(LOCALIZATION_TASKS)
+    results = empty_results()
+
+    seen = set()
+    for img_id, task, seg_item in tqdm(iter_segmentations(seg_path)):
+        if img_id not in gt or task not in tasks:
+            continue
+        seen.add((img_id, task))
+        add_counts(results, task,
+                   confusion_counts(seg_item, gt.item(img_id, task),
+                                    gt.area(img_id, task)))
+
+    for task in tasks:
+        for img_id in gt.cxr_ids:
+            if (img_id, task) not in seen:
+                add_counts(results, task,
+                           confusion_counts(None, gt.item(img_id, task),
+                                            gt.area(img_id, task)))
     return results
 
 
+def empty_results():
+    """Return zero TP, TN, FP and FN counts for each pathology."""
+    return {task: dict.fromkeys(['tp', 'tn', 'fp', 'fn'], np.int64(0))
+            for task in sorted(LOCALIZATION_TASKS)}
+
+
+def add_counts(results, task, counts):
+    """Add the (TP, TN, FP, FN) counts of one CXR to the pathology totals."""
+    for key, count in zip(['tp', 'tn', 'fp', 'fn'], counts):
+        results[task][key] += np.int64(count)
+
+
 def calculate_precision_recall_specificity(dict_item):
     TP = dict_item['tp']
     TN = dict_item['tn']
@@ -64,40 +106,57 @@ def calculate_precision_recall_specificity(dict_item):
 
 
 def main(args):
-    with open(args.gt_path) as f:
-        gt_dict = json.load(f)
-
-    for source in ['pred', 'hb']:
-        seg_path = args.pred_seg_path if source == 'pred' else args.hb_seg_path
-        results = get_results(gt_dict, seg_path)
-        precisions = []
-        recalls = []
-        specificities = []
-        for t in sorted(LOCALIZATION_TASKS):
-            p, r, s = calculate_precision_recall_specificity(results[t])
-            precisions.append(p)
-            recalls.append(r)
-            specificities.append(s)
-
-        df = pd.DataFrame()
-        df['pathology'] = sorted(LOCALIZATION_TASKS)
-        df['precision'] = precisions
-        df['recall/sensitivity'] = recalls
-        df['specificity'] = specificities
-        df.to_csv(f'{args.save_dir}/{source}_precision_recall_specificity.csv')
+    # load and index the ground truth once for both sources
+    with GroundTruthIndex.load(args.gt_path) as gt:
+
+        for source in ['pred', 'hb']:
+            seg_path = args.pred_seg_path if source == 'pred' \
+                else args.hb_seg_path
+            results = get_results(gt, seg_path)
+            save_results(results, source, args.save_dir)
+
+
+def save_results(results, source, save_dir):
+    """
+    Save precision, recall and specificity of each pathology to
+    `{source}_precision_recall_specificity.csv`.
+
+    Args:
+        results (dict): pixel counts returned by `get_results`
+        source (str): pred or hb
+        save_dir (str): where to save the csv
+    """
+    precisions = []
+    recalls = []
+    specificities = []
+    for t in sorted(LOCALIZATION_TASKS):
+        p, r, s = calculate_precision_recall_specificity(results[t])
+        precisions.append(p)
+        recalls.append(r)
+        specificities.append(s)
+
+    df = pd.DataFrame()
+    df['pathology'] = sorted(LOCALIZATION_TASKS)
+    df['precision'] = precisions
+    df['recall/sensitivity'] = recalls
+    df['specificity'] = specificities
+    df.to_csv(f'{save_dir}/{source}_precision_recall_specificity.csv')
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--gt_path', type=str,
                         help='json file path where ground-truth segmentations \
-                              are saved (encoded)')
+                              are saved (encoded), \
+                              or segmentation container')
     parser.add_argument('--pred_seg_path', type=str,
                         help='json file path where saliency method segmentations \
-                              are saved (encoded)')
+                              are saved (encoded), \
+                              or segmentation container')
     parser.add_argument('--hb_seg_path', type=str,
                         help='json file path where human benchmark segmentations \
-                              are saved (encoded)')
+                              are saved (encoded), \
+                              or segmentation container')
     parser.add_argument('--save_dir', default='.',
                         help='where to save precision/recall results')
     args = parser.parse_args()
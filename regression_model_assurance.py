@@ -10,6 +10,7 @@ import pickle
 import torch
 
 from eval_constants import CHEXPERT_TASKS, LOCALIZATION_TASKS
+from heatmap_store import list_heatmaps, read_heatmap
 from utils import format_ci, parse_pkl_filename, run_linear_regression
 
 
@@ -22,11 +23,11 @@ def get_model_probability(map_dir):
     for task in sorted(LOCALIZATION_TASKS):
         print(f'Extracting model probability for {task}')
         probs = []
-        pkl_paths = sorted(list(Path(map_dir).rglob(f"*{task}_map.pkl")))
+        pkl_paths = list_heatmaps(map_dir, task)
         for pkl_path in pkl_paths:
             # get model probability
             task, img_id = parse_pkl_filename(pkl_path)
-            info = pickle.load(open(pkl_path,'rb'))
+            info = read_heatmap(pkl_path)
             if torch.is_tensor(info['prob']) and info['prob'].size()[0] == 14:
                 prob_idx = CHEXPERT_TASKS.index(info['task'])
                 pred_prob = info['prob'][prob_idx]
@@ -89,7 +90,8 @@ if __name__ == "__main__":
     parser.add_argument('--metric', type=str,
                         help='options are: iou or hitmiss')
     parser.add_argument('--map_dir', type=str,
-                        help='directory with pickle files containing heatmaps')
+                        help='directory with pickle files containing heatmaps, \
+                              or heatmap store (see heatmap_store.py)')
     parser.add_argument('--pred_results', type=str,
                         help='path to csv file with saliency method IoU or \
                               hit/miss results for each CXR and each pathology.')
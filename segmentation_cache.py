@@ -0,0 +1,207 @@
+"""
+Persistent on-disk cache of the segmentations derived from heatmaps, so that
+scripts rerun over the same heatmaps with small parameter changes only
+recompute the segmentations whose inputs changed.
+
+An entry is keyed by the content of the heatmap (a hash of the pickle file,
+or of the map, probability and CXR dimensions of a heatmap in a store), the
+segmentation parameters (threshold, probability cutoff, smoothing, k and lazy
+upsampling) and the code version: the sources of the segmentation path and
+the torch and cv2 versions. It stores the encoded segmentation, its area and
+the model probability of the heatmap, as a small json file.
+
+The cache is bounded in size: entries are touched when read, and the least
+recently used ones are evicted once the cache exceeds its maximum size.
+Entries are written atomically, and the size of the cache is a counter file
+updated under a file lock, so several processes (e.g. pool workers) can share
+a cache and its bound.
+"""
+from contextlib import contextmanager
+import cv2
+from functools import lru_cache
+import hashlib
+import json
+import numpy as np
+import os
+from pathlib import Path
+import torch
+try:
+    import fcntl
+except ImportError:
+    # no file locking (Windows): a cache should not be shared by processes
+    fcntl = None
+
+from heatmap_store import StoredHeatmap, read_heatmap
+
+CACHE_VERSION = 1
+# maximum size of a cache (bytes) before least recently used entries are
+# evicted
+DEFAULT_MAX_BYTES = 1 << 30
+# eviction frees space down to this fraction of the maximum size
+EVICT_TO = 0.9
+
+# modules whose code determines a segmentation
+_SOURCES = ['heatmap_to_segmentation.py', 'lazy_heatmap.py',
+            'heatmap_store.py', 'utils.py']
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    """Hash of the segmentation code and of the libraries it depends on."""
+    digest = hashlib.sha256()
+    digest.update(f'{CACHE_VERSION} {torch.__version__} '
+                  f'{cv2.__version__}'.encode())
+    for source in _SOURCES:
+        digest.update((Path(__file__).parent / source).read_bytes())
+    return digest.hexdigest()
+
+
+def heatmap_digest(pkl_path):
+    """
+    Hash the content of a heatmap, given a pickle file path or a
+    `StoredHeatmap`.
+    """
+    digest = hashlib.sha256()
+    if isinstance(pkl_path, StoredHeatmap):
+        info = read_heatmap(pkl_path)
+        digest.update(info['map'].numpy().tobytes())
+        digest.update(json.dumps([info['prob'], list(info['cxr_dims']),
+                                  list(info['map'].shape)]).encode())
+    else:
+        with open(pkl_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SegmentationCache:
+    """
+    Size-bounded LRU cache of encoded segmentations in a directory. The
+    object only holds the directory and the bound, so it can be sent to
+    worker processes.
+
+    Args:
+        cache_dir (str): directory of the cache, created if needed
+        max_bytes (int): maximum size of the cache
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+        self.size_path = self.cache_dir / 'size'
+        self.lock_path = self.cache_dir / 'lock'
+        if not self.size_path.is_file():
+            with self._locked():
+                if not self.size_path.is_file():
+                    self._write_size(sum(size for _, size, _ in
+                                         self._entries()))
+
+    @contextmanager
+    def _locked(self):
+        """Hold the lock of the cache, shared by every process."""
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_size(self):
+        try:
+            return int(self.size_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return sum(size for _, size, _ in self._entries())
+
+    def _write_size(self, size):
+        tmp_path = self.size_path.with_name(f'.size.{os.getpid()}')
+        tmp_path.write_text(str(size))
+        os.replace(tmp_path, self.size_path)
+
+    @property
+    def size(self):
+        """Total size of the entries, as counted by every process."""
+        return self._read_size()
+
+    def _entries(self):
+        """Yield (path, size, last access time) of every entry."""
+        for path in self.cache_dir.glob('*/*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f'{key}.json'
+
+    def key(self, pkl_path, threshold=np.nan, prob_cutoff=0, smoothing=False,
+            k=0, lazy=False):
+        """
+        Return the key of the segmentation of a heatmap with the parameters
+        of `pkl_to_mask`.
+        """
+        fields = {'heatmap': heatmap_digest(pkl_path),
+                  'threshold': None if np.isnan(threshold) else float(threshold),
+                  'prob_cutoff': float(prob_cutoff),
+                  'smoothing': bool(smoothing),
+                  'k': int(k),
+                  'lazy': bool(lazy),
+                  'code': code_version()}
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode())\
+            .hexdigest()
+
+    def get(self, key):
+        """
+        Return the entry {'rle': RLE, 'area': int, 'prob': float} of `key`,
+        or None if it is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            # mark as recently used
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        """Store an entry, evicting old entries if the cache is too large."""
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        data = json.dumps(entry).encode()
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}')
+        tmp_path.write_bytes(data)
+
+        with self._locked():
+            # an entry that is replaced no longer counts
+            try:
+                old_size = path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(tmp_path, path)
+            size = self._read_size() + len(data) - old_size
+            if size > self.max_bytes:
+                size = self._evict()
+            self._write_size(size)
+
+    def _evict(self):
+        """
+        Remove least recently used entries down to a fraction of the maximum
+        size, with the lock held. Returns the size of the remaining entries,
+        recomputed from the files.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(size for _, size, _ in entries)
+        for path, entry_size, _ in entries:
+            if size <= EVICT_TO * self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        return size
\ No newline at end of file
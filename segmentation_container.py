@@ -0,0 +1,284 @@
+"""
+Indexed binary container for encoded segmentations, an alternative to the
+{cxr_id: {task: RLE}} json files that supports random access without parsing
+the whole file.
+
+A container is a single file with:
+-- an 8-byte magic string and the 8-byte length of the header;
+-- the header, a json object with the format version, the CXR ids and the
+   tasks, in the order of the original json file, and the first index record
+   of every CXR;
+-- the index, one fixed-size record per segmentation with its CXR and task
+   codes, size, area, bounding box and the offset and length of its counts;
+-- the payload, the compressed RLE counts of every segmentation.
+
+Opening a container reads the header only; the index is memory-mapped and
+counts are read when a segmentation is accessed. Areas and bounding boxes
+are precomputed, so they do not require reading the counts at all.
+
+Every script that takes an encoded segmentation file (`--gt_path`,
+`--seg_path`, `--pred_path`, ...) also accepts a container. Converting a json
+file to a container and back gives the original file byte for byte.
+"""
+from argparse import ArgumentParser
+from collections.abc import Mapping
+import json
+import numpy as np
+import os
+from pathlib import Path
+from pycocotools import mask
+import shutil
+
+MAGIC = b'CXRSEG\x00\x01'
+CONTAINER_VERSION = 1
+
+RECORD_DTYPE = np.dtype([('cxr', '<u4'),
+                         ('task', '<u2'),
+                         ('height', '<u4'),
+                         ('width', '<u4'),
+                         ('area', '<u8'),
+                         ('bbox', '<f8', (4,)),
+                         ('offset', '<u8'),
+                         ('length', '<u8')])
+
+
+def is_segmentation_container(seg_path):
+    """Return True if `seg_path` is a container rather than a json file."""
+    if not Path(seg_path).is_file():
+        return False
+    with open(seg_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class SegmentationContainer(Mapping):
+    """
+    Random-access reader of a container. Behaves like the dictionary
+    {cxr_id: {task: RLE}} loaded from the equivalent json file. Counts are
+    read through a file opened on first access; use the reader as a context
+    manager, or call `close`, to close it.
+
+    Args:
+        seg_path (str): container file written by `SegmentationContainerWriter`
+    """
+    def __init__(self, seg_path):
+        with open(seg_path, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, \
+                f'{seg_path} is not a segmentation container'
+            header_length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_length))
+        assert header['version'] == CONTAINER_VERSION, \
+            f"unsupported segmentation container version {header['version']}"
+
+        self.seg_path = str(seg_path)
+        self.cxr_ids = header['cxr_ids']
+        self.tasks = header['tasks']
+        self.cxr_starts = header['cxr_starts']
+        self._cxr_codes = {cxr_id: i for i, cxr_id in enumerate(self.cxr_ids)}
+
+        index_offset = len(MAGIC) + 8 + header_length
+        num_records = header['num_records']
+        if num_records:
+            self.index = np.memmap(seg_path, dtype=RECORD_DTYPE, mode='r',
+                                   offset=index_offset, shape=(num_records,))
+        else:
+            self.index = np.zeros(0, dtype=RECORD_DTYPE)
+        self.payload_offset = index_offset + num_records * RECORD_DTYPE.itemsize
+        self._f = None
+
+    def close(self):
+        """Close the file of the counts (reopened if counts are read again)."""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _records_of(self, cxr_id):
+        """Return the index rows [start, stop) of a CXR."""
+        code = self._cxr_codes[cxr_id]
+        return self.cxr_starts[code], self.cxr_starts[code + 1]
+
+    def _row(self, cxr_id, task):
+        start, stop = self._records_of(cxr_id)
+        for row in range(start, stop):
+            if self.tasks[self.index[row]['task']] == task:
+                return row
+        raise KeyError(task)
+
+    def _read_counts(self, row):
+        if self._f is None:
+            self._f = open(self.seg_path, 'rb')
+        record = self.index[row]
+        self._f.seek(self.payload_offset + int(record['offset']))
+        return self._f.read(int(record['length'])).decode()
+
+    def _rle(self, row):
+        record = self.index[row]
+        return {'size': [int(record['height']), int(record['width'])],
+                'counts': self._read_counts(row)}
+
+    def __getitem__(self, cxr_id):
+        start, stop = self._records_of(cxr_id)
+        return {self.tasks[self.index[row]['task']]: self._rle(row)
+                for row in range(start, stop)}
+
+    def __contains__(self, cxr_id):
+        return cxr_id in self._cxr_codes
+
+    def __iter__(self):
+        return iter(self.cxr_ids)
+
+    def __len__(self):
+        return len(self.cxr_ids)
+
+    def item(self, cxr_id, task):
+        """Return the encoded segmentation of `task` for `cxr_id`."""
+        return self._rle(self._row(cxr_id, task))
+
+    def area(self, cxr_id, task):
+        """Return the number of foreground pixels in the segmentation."""
+        return int(self.index[self._row(cxr_id, task)]['area'])
+
+    def bbox(self, cxr_id, task):
+        """Return the [x, y, w, h] bounding box of the segmentation."""
+        return self.index[self._row(cxr_id, task)]['bbox'].tolist()
+
+    def record_areas(self):
+        """Yield (cxr_id, task, area) records in file order from the index."""
+        codes = zip(self.index['cxr'].tolist(), self.index['task'].tolist(),
+                    self.index['area'].tolist())
+        for cxr, task, area in codes:
+            yield self.cxr_ids[cxr], self.tasks[task], area
+
+    def records(self):
+        """Yield (cxr_id, task, RLE) records in file order."""
+        for row in range(len(self.index)):
+            record = self.index[row]
+            yield (self.cxr_ids[record['cxr']], self.tasks[record['task']],
+                   self._rle(row))
+
+
+class SegmentationContainerWriter:
+    """
+    Write a container record by record. Records of a CXR must be written
+    consecutively; the file is written once the writer is closed (use it as
+    a context manager, so that nothing is saved if an exception is raised).
+    Counts are staged in a temporary file next to the output so that the
+    header and index can be written first.
+
+    Args:
+        seg_path (str): container file path
+    """
+    def __init__(self, seg_path):
+        self.seg_path = str(seg_path)
+        self.payload_path = self.seg_path + '.payload'
+        self.payload = open(self.payload_path, 'wb')
+        self.cxr_ids = []
+        self.cxr_starts = []
+        self.tasks = []
+        self._cxr_codes = {}
+        self._task_codes = {}
+        self.records = []
+        self.offset = 0
+
+    def write(self, cxr_id, task, rle):
+        """Append the segmentation of `task` for `cxr_id`."""
+        if cxr_id not in self._cxr_codes:
+            self._cxr_codes[cxr_id] = len(self.cxr_ids)
+            self.cxr_ids.append(cxr_id)
+            self.cxr_starts.append(len(self.records))
+        elif self._cxr_codes[cxr_id] != len(self.cxr_ids) - 1:
+            raise ValueError(f'Records of {cxr_id} are not consecutive')
+        if task not in self._task_codes:
+            self._task_codes[task] = len(self.tasks)
+            self.tasks.append(task)
+
+        h, w = rle['size']
+        if isinstance(rle['counts'], list):
+            rle = mask.frPyObjects(rle, h, w)
+        counts = rle['counts']
+        if isinstance(counts, str):
+            counts = counts.encode()
+        compressed = {'size': [h, w], 'counts': counts}
+
+        self.payload.write(counts)
+        self.records.append((self._cxr_codes[cxr_id], self._task_codes[task],
+                             h, w, int(mask.area(compressed)),
+                             mask.toBbox(compressed).tolist(),
+                             self.offset, len(counts)))
+        self.offset += len(counts)
+
+    def __len__(self):
+        return len(self.cxr_ids)
+
+    def close(self):
+        if self.payload.closed:
+            return
+        self.payload.close()
+        header = json.dumps({'version': CONTAINER_VERSION,
+                             'num_records': len(self.records),
+                             'cxr_ids': self.cxr_ids,
+                             'cxr_starts': self.cxr_starts + [len(self.records)],
+                             'tasks': self.tasks}).encode()
+        index = np.array(self.records, dtype=RECORD_DTYPE)
+        tmp_path = self.seg_path + '.partial'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.array([len(header)], dtype='<u8').tobytes())
+            f.write(header)
+            f.write(index.tobytes())
+            with open(self.payload_path, 'rb') as payload:
+                shutil.copyfileobj(payload, f)
+        os.remove(self.payload_path)
+        os.replace(tmp_path, self.seg_path)
+
+    def abort(self):
+        """Discard the records written so far."""
+        if not self.payload.closed:
+            self.payload.close()
+            os.remove(self.payload_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def convert(input_path, output_path):
+    """
+    Convert an encoded segmentation json file to a container, or a container
+    back to a json file, depending on the format of `input_path`.
+    """
+    # imported here since segmentation_json dispatches to this module
+    from segmentation_json import SegmentationWriter, iter_segmentations
+
+    if is_segmentation_container(input_path):
+        writer = SegmentationWriter(output_path)
+    else:
+        writer = SegmentationContainerWriter(output_path)
+    with writer:
+        for cxr_id, task, rle in iter_segmentations(input_path):
+            writer.write(cxr_id, task, rle)
+    print(f'Converted {len(writer)} CXRs from {input_path} to {output_path}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--input_path', type=str,
+                        help='json file or container with encoded \
+                              segmentations')
+    parser.add_argument('--output_path', type=str,
+                        help='where to save the converted segmentations; a \
+                              json input is converted to a container and a \
+                              container to json')
+    args = parser.parse_args()
+
+    convert(args.input_path, args.output_path)
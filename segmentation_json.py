@@ -0,0 +1,247 @@
+"""
+Incremental reading and writing of encoded segmentation files, the json
+dictionaries {cxr_id: {task: RLE}} written by `annotation_to_segmentation.py`
+and `heatmap_to_segmentation.py`.
+
+`iter_segmentations` yields one (cxr_id, task, RLE) record at a time without
+loading the whole file, and `SegmentationWriter` appends records as they are
+produced. The writer output is byte for byte what `json.dump` writes for the
+equivalent dictionary, so files written either way are interchangeable.
+
+Both `iter_segmentations` and `load_segmentations` also accept the indexed
+binary containers of `segmentation_container.py`.
+"""
+from functools import lru_cache
+import json
+import os
+from pycocotools import mask
+
+from segmentation_container import (SegmentationContainer,
+                                    is_segmentation_container)
+
+# characters read from a segmentation file at a time
+CHUNK_SIZE = 1 << 20
+# segmentations whose areas are computed in one call
+AREA_BATCH_SIZE = 4096
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _JsonStream:
+    """Buffered reader of consecutive json tokens and values of a file."""
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Read another chunk, dropping what was already parsed."""
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def _skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return
+            self._fill()
+
+    def peek(self):
+        """Return the next non-whitespace character ('' at end of file)."""
+        self._skip_whitespace()
+        return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of `chars`."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f'Expected one of {chars!r} at character '
+                             f'{self.pos} of buffer, got {char!r}')
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Parse the next json value."""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number could continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_segmentations(seg_path):
+    """
+    Read an encoded segmentation file record by record.
+
+    Args:
+        seg_path (str): json file path where segmentations are saved
+                        (encoded), or segmentation container
+
+    Yields:
+        cxr_id (str), task (str), rle (dict)
+    """
+    if is_segmentation_container(seg_path):
+        with SegmentationContainer(seg_path) as container:
+            yield from container.records()
+        return
+
+    with open(seg_path) as f:
+        stream = _JsonStream(f)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            cxr_id = stream.value()
+            stream.expect(':')
+            stream.expect('{')
+            if stream.peek() == '}':
+                stream.expect('}')
+            else:
+                while True:
+                    task = stream.value()
+                    stream.expect(':')
+                    yield cxr_id, task, stream.value()
+                    if stream.expect(',}') == '}':
+                        break
+            if stream.expect(',}') == '}':
+                return
+
+
+def iter_segmentation_areas(seg_path, batch_size=AREA_BATCH_SIZE):
+    """
+    Read the foreground area of every segmentation of a file, without
+    decoding any mask. Areas of json files are computed from the counts in
+    batches; containers store them in their index.
+
+    Args:
+        seg_path (str): json file path where segmentations are saved
+                        (encoded), or segmentation container
+
+    Yields:
+        cxr_id (str), task (str), area (int)
+    """
+    if is_segmentation_container(seg_path):
+        with SegmentationContainer(seg_path) as container:
+            yield from container.record_areas()
+        return
+
+    batch = []
+    for record in iter_segmentations(seg_path):
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield from _batch_areas(batch)
+            batch = []
+    yield from _batch_areas(batch)
+
+
+def _batch_areas(batch):
+    if not batch:
+        return
+    rles = [rle for _, _, rle in batch]
+    # uncompressed counts are compressed the way mask.area expects
+    rles = [mask.frPyObjects(rle, *rle['size'])
+            if isinstance(rle['counts'], list) else rle for rle in rles]
+    for (cxr_id, task, _), area in zip(batch, mask.area(rles).tolist()):
+        yield cxr_id, task, area
+
+
+def load_segmentations(seg_path):
+    """
+    Load encoded segmentations for random access: a json file is parsed into
+    a dictionary {cxr_id: {task: RLE}}, and a container is opened lazily as
+    an equivalent read-only mapping.
+
+    Args:
+        seg_path (str): json file path where segmentations are saved
+                        (encoded), or segmentation container
+    """
+    if is_segmentation_container(seg_path):
+        return SegmentationContainer(seg_path)
+    with open(seg_path) as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def load_shared_segmentations(seg_path):
+    """
+    Load segmentations once per process (see `load_segmentations`), e.g. the
+    ground truth used by every job of a pool worker. The result is shared by
+    the callers, so it must not be modified.
+    """
+    return load_segmentations(seg_path)
+
+
+class SegmentationWriter:
+    """
+    Write an encoded segmentation file record by record.
+
+    Records of a CXR must be written consecutively. Records are written to a
+    temporary file that replaces `seg_path` once the writer is closed; use it
+    as a context manager, so that nothing is saved if an exception is raised.
+
+    Args:
+        seg_path (str): json file path for saving encoded segmentations
+    """
+    def __init__(self, seg_path):
+        self.seg_path = str(seg_path)
+        self.tmp_path = self.seg_path + '.partial'
+        self.f = open(self.tmp_path, 'w')
+        self.f.write('{')
+        self.cxr_id = None
+        self.written = set()
+
+    def write(self, cxr_id, task, rle):
+        """Append the segmentation of `task` for `cxr_id`."""
+        if cxr_id != self.cxr_id:
+            if cxr_id in self.written:
+                raise ValueError(f'Records of {cxr_id} are not consecutive')
+            if self.cxr_id is not None:
+                self.f.write('}, ')
+            self.f.write(f'{json.dumps(cxr_id)}: {{')
+            self.cxr_id = cxr_id
+            self.written.add(cxr_id)
+        else:
+            self.f.write(', ')
+        self.f.write(f'{json.dumps(task)}: {json.dumps(rle)}')
+
+    def __len__(self):
+        return len(self.written)
+
+    def close(self):
+        """Complete the file and move it to `seg_path`."""
+        if self.f.closed:
+            return
+        if self.cxr_id is not None:
+            self.f.write('}')
+        self.f.write('}')
+        self.f.close()
+        os.replace(self.tmp_path, self.seg_path)
+
+    def abort(self):
+        """Discard the records written so far."""
+        if not self.f.closed:
+            self.f.close()
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from annotation_to_segmentation import create_mask, polygons_to_rle
+from utils import encode_segmentation
+
+
+def random_polygons(rng, height, width):
+    """Polygons with float, integer, out-of-bounds and repeated coordinates."""
+    size = max(height, width)
+    polygons = []
+    for _ in range(rng.integers(1, 4)):
+        n = rng.integers(2, 12)
+        kind = rng.integers(0, 4)
+        if kind == 0:
+            points = rng.uniform(-10, size + 10, (n, 2))
+        elif kind == 1:
+            points = rng.integers(-5, size + 5, (n, 2))
+        elif kind == 2:
+            # many horizontal and vertical edges
+            points = rng.integers(0, 8, (n, 2)) * (size // 8 + 1)
+        else:
+            center, radius = rng.uniform(0, size, 2), rng.uniform(1, size)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+            points = center + radius * np.stack([np.cos(angles),
+                                                 np.sin(angles)], axis=1)
+        polygons.append(points.tolist())
+    return polygons
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_create_mask(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(200):
+        img_dims = [int(d) for d in rng.integers(1, 60, 2)]
+        polygons = random_polygons(rng, *img_dims)
+        assert polygons_to_rle(polygons, img_dims) == \
+            encode_segmentation(create_mask(polygons, img_dims))
+
+
+def test_matches_create_mask_on_a_cxr():
+    rng = np.random.default_rng(0)
+    img_dims = [2828, 2320]
+    polygons = []
+    for n in [40, 150]:
+        center, radius = rng.uniform(500, 2000, 2), rng.uniform(100, 900)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+        radii = radius * rng.uniform(0.7, 1, n)
+        polygons.append((center + np.stack([radii * np.cos(angles),
+                                            radii * np.sin(angles)],
+                                           axis=1)).tolist())
+    assert polygons_to_rle(polygons, img_dims) == \
+        encode_segmentation(create_mask(polygons, img_dims))
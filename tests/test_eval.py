@@ -0,0 +1,38 @@
+import json
+import numpy as np
+import pandas as pd
+
+from eval import evaluate
+from eval_constants import LOCALIZATION_TASKS
+from utils import encode_segmentation
+
+
+def random_segmentations(path, cxr_ids, seed):
+    rng = np.random.default_rng(seed)
+    segs = {cxr_id: {task: encode_segmentation(rng.random((8, 8)) < 0.3)
+                     for task in LOCALIZATION_TASKS}
+            for cxr_id in cxr_ids}
+    with open(path, 'w') as f:
+        json.dump(segs, f)
+    return path
+
+
+def run(gt_path, pred_path, save_dir, incremental):
+    evaluate(gt_path, pred_path, save_dir, 'iou', False, False,
+             num_replicates=10, incremental=incremental)
+    return pd.read_csv(save_dir / 'iou_results_per_cxr.csv')
+
+
+def test_incremental_ignores_results_of_other_runs(tmp_path):
+    cxr_ids = [f'patient{i}_study1_view1_frontal' for i in range(4)]
+    gt_path = random_segmentations(tmp_path / 'gt.json', cxr_ids, 0)
+    pred_a = random_segmentations(tmp_path / 'a.json', cxr_ids, 1)
+    pred_b = random_segmentations(tmp_path / 'b.json', cxr_ids, 2)
+    save_dir = tmp_path / 'results'
+
+    run(gt_path, pred_a, save_dir, incremental=True)
+    # a normal run overwrites the results of the incremental one
+    run(gt_path, pred_b, save_dir, incremental=False)
+    results = run(gt_path, pred_a, save_dir, incremental=True)
+    expected = run(gt_path, pred_a, tmp_path / 'fresh', incremental=False)
+    pd.testing.assert_frame_equal(results, expected)
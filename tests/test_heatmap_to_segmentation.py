@@ -0,0 +1,86 @@
+"""
+Regression test of the Otsu branch of `cam_to_segmentation` against the
+original implementation, which drew every contour of `cv2.RETR_TREE` as a PIL
+polygon. Set HEATMAP_TEST_DIR to a directory of heatmap pickle files (or a
+heatmap store) to also compare on real heatmaps.
+"""
+import cv2
+import numpy as np
+import os
+from PIL import Image, ImageDraw
+import pytest
+import torch
+import torch.nn.functional as F
+
+from heatmap_store import list_heatmaps
+from heatmap_to_segmentation import (cam_to_segmentation, load_heatmap,
+                                     normalize_heatmap)
+
+SMOOTHING = [(False, 0), (True, 3), (True, 15)]
+
+
+def reference_segmentation(cam_mask, smoothing, k):
+    """Otsu's method followed by a PIL fill of every contour of the tree."""
+    mask = np.uint8(255 * normalize_heatmap(cam_mask))
+    if smoothing:
+        heatmap = cv2.applyColorMap(mask, cv2.COLORMAP_JET)
+        gray_img = cv2.boxFilter(cv2.cvtColor(heatmap, cv2.COLOR_RGB2GRAY),
+                                 -1, (k, k))
+        mask = 255 - gray_img
+    thresh = cv2.threshold(mask, 0, np.max(mask), cv2.THRESH_OTSU)[1]
+
+    cnts = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    cnts = cnts[0] if len(cnts) == 2 else cnts[1]
+    segmentation = Image.new('1', (mask.shape[1], mask.shape[0]))
+    for cnt in cnts:
+        if len(cnt) > 1:
+            coords = [(pt[0][0], pt[0][1]) for pt in cnt]
+            ImageDraw.Draw(segmentation).polygon(coords, outline=1, fill=1)
+    return np.array(segmentation, dtype=np.uint8)
+
+
+def assert_same_segmentation(cam_mask):
+    for smoothing, k in SMOOTHING:
+        expected = reference_segmentation(cam_mask, smoothing, k)
+        segmentation = cam_to_segmentation(cam_mask, smoothing=smoothing, k=k)
+        np.testing.assert_array_equal(segmentation, expected)
+
+
+def smooth_maps(rng, num_maps):
+    """Low-resolution maps upsampled to CXR-like sizes."""
+    for _ in range(num_maps):
+        h, w = rng.integers(2, 40, 2)
+        height, width = rng.integers(50, 800, 2)
+        saliency_map = rng.random((h, w), dtype=np.float32)
+        saliency_map **= rng.choice([1, 3, 8])
+        yield F.interpolate(torch.from_numpy(saliency_map)[None, None],
+                            size=(int(height), int(width)), mode='bilinear',
+                            align_corners=False)
+
+
+def fragmented_maps(rng, num_maps):
+    """Noisy maps with many small components, holes and thin contours."""
+    for _ in range(num_maps):
+        height, width = rng.integers(20, 300, 2)
+        yield torch.from_numpy(rng.random((int(height), int(width)),
+                                          dtype=np.float32) ** 4)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_otsu_matches_pil_fill_on_smooth_maps(seed):
+    for cam_mask in smooth_maps(np.random.default_rng(seed), 25):
+        assert_same_segmentation(cam_mask)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_otsu_matches_pil_fill_on_fragmented_maps(seed):
+    for cam_mask in fragmented_maps(np.random.default_rng(seed), 25):
+        assert_same_segmentation(cam_mask)
+
+
+@pytest.mark.skipif('HEATMAP_TEST_DIR' not in os.environ,
+                    reason='HEATMAP_TEST_DIR is not set')
+def test_otsu_matches_pil_fill_on_heatmaps():
+    for pkl_path in list_heatmaps(os.environ['HEATMAP_TEST_DIR']):
+        cam_mask, _ = load_heatmap(pkl_path)
+        assert_same_segmentation(cam_mask)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from heatmap_to_segmentation import normalize_heatmap
+from lazy_heatmap import SMALL_OUTPUT_PIXELS, LazyHeatmap
+
+# (map height, map width, CXR width, CXR height): small outputs, upsampled
+# with F.interpolate, and larger ones computed band by band
+SIZES = [(7, 9, 30, 40), (2, 3, 5, 4), (10, 10, 10, 10), (8, 6, 250, 255),
+         (7, 9, 300, 410), (16, 16, 517, 389), (5, 11, 1021, 733),
+         (12, 12, 12, 700)]
+
+
+def random_maps(height, width, seed):
+    """A continuous map, and a quantized one with many tied maxima."""
+    rng = np.random.default_rng(seed)
+    smooth = rng.random((height, width), dtype=np.float32)
+    tied = rng.integers(0, 3, (height, width)).astype(np.float32) / 2
+    return [smooth, tied]
+
+
+def reference(saliency_map, img_dims):
+    return F.interpolate(torch.from_numpy(saliency_map)[None, None],
+                         size=(img_dims[1], img_dims[0]), mode='bilinear',
+                         align_corners=False)
+
+
+def test_sizes_cover_both_paths():
+    pixels = [w * h for _, _, w, h in SIZES]
+    assert min(pixels) <= SMALL_OUTPUT_PIXELS < max(pixels)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('height, width, cxr_width, cxr_height', SIZES)
+def test_matches_interpolate(height, width, cxr_width, cxr_height, seed):
+    img_dims = (cxr_width, cxr_height)
+    for saliency_map in random_maps(height, width, seed):
+        expected = reference(saliency_map, img_dims)
+        lazy = LazyHeatmap(saliency_map, img_dims)
+
+        assert torch.equal(lazy.to_tensor(), expected)
+        bands = np.concatenate([band for _, band in lazy.bands(band_rows=37)])
+        np.testing.assert_array_equal(bands, expected.numpy()[0, 0])
+
+        full = expected.numpy()[0, 0]
+        assert lazy.argmax() == np.unravel_index(np.argmax(full), full.shape)
+
+        normalized = normalize_heatmap(expected)
+        for threshold in [0.2, 0.5, 0.7]:
+            np.testing.assert_array_equal(
+                lazy.threshold(threshold),
+                (normalized > threshold).astype(np.uint8))
@@ -0,0 +1,39 @@
+from multiprocessing import Pool
+
+from segmentation_cache import SegmentationCache
+
+ENTRY = {'rle': {'size': [2, 2], 'counts': '04'}, 'area': 0, 'prob': 0.5}
+
+
+def entry_size(cache):
+    return sum(size for _, size, _ in cache._entries())
+
+
+def _put(job):
+    cache, key = job
+    cache.put(key, ENTRY)
+
+
+def test_replacing_an_entry_counts_it_once(tmp_path):
+    cache = SegmentationCache(tmp_path)
+    cache.put('ab01', ENTRY)
+    cache.put('ab01', dict(ENTRY, area=100))
+    assert cache.get('ab01')['area'] == 100
+    assert cache.size == entry_size(cache)
+
+
+def test_size_is_shared_by_processes(tmp_path):
+    cache = SegmentationCache(tmp_path)
+    with Pool(4) as pool:
+        pool.map(_put, [(cache, f'{i:04x}') for i in range(64)])
+    assert cache.size == entry_size(cache)
+    # a new handle reads the counter instead of scanning the entries
+    assert SegmentationCache(tmp_path).size == cache.size
+
+
+def test_eviction_bounds_the_cache(tmp_path):
+    cache = SegmentationCache(tmp_path, max_bytes=1000)
+    with Pool(4) as pool:
+        pool.map(_put, [(cache, f'{i:04x}') for i in range(64)])
+    assert cache.size == entry_size(cache)
+    assert cache.size <= 1000
@@ -0,0 +1,30 @@
+import json
+import numpy as np
+
+from ground_truth import GroundTruthIndex
+from segmentation_container import SegmentationContainer, convert
+from utils import encode_segmentation
+
+RLE = encode_segmentation(np.zeros((2, 2)))
+FULL = encode_segmentation(np.ones((2, 2)))
+
+
+def test_container_closes_and_reopens(tmp_path):
+    json_path = tmp_path / 'segs.json'
+    json_path.write_text(json.dumps({'cxr1': {'Edema': RLE},
+                                     'cxr2': {'Edema': FULL}}))
+    seg_path = tmp_path / 'segs.seg'
+    convert(json_path, seg_path)
+
+    with SegmentationContainer(seg_path) as container:
+        assert container['cxr1'] == {'Edema': RLE}
+        f = container._f
+    assert f.closed and container._f is None
+    # reading again reopens the file
+    assert container.item('cxr2', 'Edema') == FULL
+    container.close()
+
+    with GroundTruthIndex.load(str(seg_path)) as gt:
+        assert gt.area('cxr2', 'Edema') == 4
+        assert gt.item('cxr1', 'Edema') == RLE
+    assert gt.gt_dict._f is None
@@ -0,0 +1,29 @@
+import json
+import pytest
+
+from segmentation_json import SegmentationWriter, iter_segmentations
+
+RLE = {'size': [2, 2], 'counts': '04'}
+
+
+def test_writer_matches_json_dump(tmp_path):
+    seg_path = tmp_path / 'segs.json'
+    with SegmentationWriter(seg_path) as writer:
+        writer.write('cxr1', 'Edema', RLE)
+        writer.write('cxr1', 'Atelectasis', RLE)
+        writer.write('cxr2', 'Edema', RLE)
+    expected = {'cxr1': {'Edema': RLE, 'Atelectasis': RLE},
+                'cxr2': {'Edema': RLE}}
+    assert seg_path.read_text() == json.dumps(expected)
+    assert list(iter_segmentations(seg_path)) == [
+        ('cxr1', 'Edema', RLE), ('cxr1', 'Atelectasis', RLE),
+        ('cxr2', 'Edema', RLE)]
+
+
+def test_writer_saves_nothing_on_error(tmp_path):
+    seg_path = tmp_path / 'segs.json'
+    with pytest.raises(RuntimeError):
+        with SegmentationWriter(seg_path) as writer:
+            writer.write('cxr1', 'Edema', RLE)
+            raise RuntimeError
+    assert list(tmp_path.iterdir()) == []
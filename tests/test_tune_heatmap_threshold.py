@@ -0,0 +1,132 @@
+import numpy as np
+import pickle
+import pytest
+import torch
+
+from heatmap_to_segmentation import normalize_heatmap
+from tune_heatmap_threshold import (get_task_histograms, sweep_ious,
+                                    tune_threshold)
+from utils import encode_segmentation
+
+THRESHOLDS = np.arange(0.2, .8, .1)
+
+
+def reference_ious(heatmap, gt_mask, thresholds):
+    """IoU of `heatmap > threshold` on the true positive slice."""
+    ious = []
+    for threshold in thresholds:
+        pred_mask = heatmap > threshold
+        if pred_mask.sum() == 0 or gt_mask.sum() == 0:
+            ious.append(np.nan)
+        else:
+            ious.append(np.logical_and(pred_mask, gt_mask).sum() /
+                        np.logical_or(pred_mask, gt_mask).sum())
+    return np.array(ious)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sweep_ious_matches_thresholding(seed):
+    rng = np.random.default_rng(seed)
+    heatmap = normalize_heatmap(torch.rand(1, 1, 40, 30,
+                                           generator=torch.manual_seed(seed)))
+    gt_mask = (rng.random((40, 30)) > 0.7).astype(np.uint8)
+    np.testing.assert_array_equal(sweep_ious(heatmap, gt_mask, THRESHOLDS),
+                                  reference_ious(heatmap, gt_mask, THRESHOLDS))
+
+
+def test_sweep_ious_constant_heatmap():
+    # a constant (e.g. all-zero Grad-CAM) map normalizes to all NaN, which is
+    # never above a threshold
+    with np.errstate(invalid='ignore'):
+        heatmap = normalize_heatmap(torch.zeros(1, 1, 40, 30))
+    assert np.isnan(heatmap).all()
+    gt_mask = np.zeros((40, 30), dtype=np.uint8)
+    gt_mask[:10, :10] = 1
+    ious = sweep_ious(heatmap, gt_mask, THRESHOLDS)
+    assert np.isnan(ious).all()
+    np.testing.assert_array_equal(ious,
+                                  reference_ious(heatmap, gt_mask, THRESHOLDS))
+
+
+def write_heatmaps(map_dir, num_maps):
+    """Write random Edema heatmaps and return their ground truth."""
+    map_dir.mkdir(exist_ok=True)
+    gt = {}
+    for i in range(num_maps):
+        img_id = f'patient{i}_study1_view1_frontal'
+        with open(map_dir / f'{img_id}_Edema_map.pkl', 'wb') as f:
+            pickle.dump({'map': torch.rand(1, 1, 7, 9), 'prob': 0.5,
+                         'task': 'Edema', 'cxr_dims': (30, 40)}, f)
+        gt_mask = np.zeros((40, 30), dtype=np.uint8)
+        gt_mask[:20, :10] = 1
+        gt[img_id] = {'Edema': encode_segmentation(gt_mask)}
+    return gt
+
+
+def test_histograms_recomputed_when_inputs_change(tmp_path):
+    map_dir = tmp_path / 'maps'
+    gt = write_heatmaps(map_dir, 2)
+
+    hist_dir = tmp_path / 'hist'
+    _, histograms = get_task_histograms('Edema', gt, map_dir, hist_dir, 10)
+    assert histograms.shape == (2, 2, 11)
+    # another number of buckets
+    _, histograms = get_task_histograms('Edema', gt, map_dir, hist_dir, 20)
+    assert histograms.shape == (2, 2, 21)
+    # another ground truth
+    gt_mask = np.zeros((40, 30), dtype=np.uint8)
+    gt['patient0_study1_view1_frontal']['Edema'] = encode_segmentation(gt_mask)
+    _, histograms = get_task_histograms('Edema', gt, map_dir, hist_dir, 20)
+    assert histograms[0, 0].sum() == 0
+    # other heatmaps
+    torch.manual_seed(1)
+    write_heatmaps(map_dir, 2)
+    _, recomputed = get_task_histograms('Edema', gt, map_dir, hist_dir, 20)
+    assert not np.array_equal(recomputed, histograms)
+
+
+def test_saved_histograms_used_without_heatmaps(tmp_path):
+    map_dir = tmp_path / 'maps'
+    gt = write_heatmaps(map_dir, 3)
+    hist_dir = tmp_path / 'hist'
+    thresholds = np.arange(0.05, 1, 0.05)
+    expected = tune_threshold('Edema', gt, map_dir, thresholds=thresholds)
+    img_ids, histograms = get_task_histograms('Edema', gt, map_dir, hist_dir,
+                                              100)
+    saved = (hist_dir / 'Edema_histograms.npz').read_bytes()
+
+    for pkl_path in map_dir.iterdir():
+        pkl_path.unlink()
+    assert get_task_histograms('Edema', gt, map_dir, hist_dir, 100)[0] == \
+        img_ids
+    assert tune_threshold('Edema', gt, map_dir, hist_dir, 100,
+                          thresholds) == expected
+    assert tune_threshold('Edema', gt, None, hist_dir, 100,
+                          thresholds) == expected
+
+    # histograms that cannot be checked or recomputed are left untouched
+    with pytest.raises(ValueError):
+        get_task_histograms('Edema', gt, map_dir, hist_dir, 50)
+    gt['patient0_study1_view1_frontal']['Edema'] = \
+        encode_segmentation(np.zeros((40, 30), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        get_task_histograms('Edema', gt, map_dir, hist_dir, 100)
+    assert (hist_dir / 'Edema_histograms.npz').read_bytes() == saved
+
+
+def test_thresholds_off_the_grid_rejected(tmp_path):
+    gt = write_heatmaps(tmp_path / 'maps', 1)
+    with pytest.raises(ValueError):
+        tune_threshold('Edema', gt, tmp_path / 'maps', tmp_path / 'hist', 100,
+                       [0.255])
+
+
+def test_undefined_miou_raises(tmp_path):
+    gt = write_heatmaps(tmp_path / 'maps', 2)
+    for img_id in gt:
+        gt[img_id]['Edema'] = \
+            encode_segmentation(np.zeros((40, 30), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        tune_threshold('Edema', gt, tmp_path / 'maps', tmp_path / 'hist')
+    with pytest.raises(ValueError):
+        tune_threshold('Edema', gt, tmp_path / 'maps')
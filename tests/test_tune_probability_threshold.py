@@ -0,0 +1,11 @@
+import numpy as np
+
+from tune_probability_threshold import cutoff_miou
+
+
+def test_cutoff_compared_in_float32():
+    components = (np.array([0.3, 0.5], dtype=np.float32),
+                  np.array([10, 10]), np.array([10, 10]), np.array([10, 20]))
+    # a probability of float32(0.3) is not above a cutoff of 0.3
+    assert cutoff_miou(0.3, components) == 0.25
+    assert cutoff_miou(0.2, components) == 0.75
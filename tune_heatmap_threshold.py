@@ -5,89 +5,458 @@ Save the best threshold for each pathology in a csv file.
 """
 from argparse import ArgumentParser
 import glob
+import hashlib
 import json
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 from pathlib import Path
 import pickle
 from pycocotools import mask
+import torch
 import torch.nn.functional as F
 from tqdm import tqdm
+import warnings
 
-from eval import calculate_iou
 from eval_constants import LOCALIZATION_TASKS
-from heatmap_to_segmentation import pkl_to_mask
+from heatmap_store import StoredHeatmap, list_heatmaps
+from heatmap_to_segmentation import load_heatmap, normalize_heatmap
+from segmentation_json import load_shared_segmentations
+from utils import parse_pkl_filename
 
+# candidate thresholds, unless others are given
+THRESHOLDS = np.arange(0.2, .8, .1)
 
-def compute_miou(threshold, cam_pkls, gt):
+
+def sweep_ious(heatmap, gt_mask, thresholds):
     """
-    Given a threshold and a list of heatmap pickle files, return the mIoU.
+    Return the IoU of the segmentation `heatmap > threshold` with the ground
+    truth for every threshold, on the true positive slice (NaN if either the
+    segmentation or the ground truth is empty).
+
+    The heatmap pixels are sorted once, so the number of pixels above each
+    threshold (inside the ground truth and overall) is a binary search.
 
     Args:
-        threshold (double): the threshold used to convert heatmaps to segmentations
+        heatmap (np.ndarray): normalized [H x W] heatmap
+        gt_mask (np.ndarray): [H x W] binary ground-truth segmentation
+        thresholds (np.ndarray): thresholds used to binarize the heatmap
+    """
+    gt_mask = gt_mask.astype(bool)
+    gt_area = np.count_nonzero(gt_mask)
+    if gt_area == 0:
+        return np.full(len(thresholds), np.nan)
+
+    # NaN pixels (constant heatmaps) are never above a threshold
+    valid = ~np.isnan(heatmap)
+    all_pixels = np.sort(heatmap[valid])
+    gt_pixels = np.sort(heatmap[gt_mask & valid])
+    pred_area = all_pixels.size - np.searchsorted(all_pixels, thresholds,
+                                                  side='right')
+    intersection = gt_pixels.size - np.searchsorted(gt_pixels, thresholds,
+                                                    side='right')
+    union = pred_area + gt_area - intersection
+
+    ious = np.full(len(thresholds), np.nan)
+    has_pred = pred_area > 0
+    ious[has_pred] = intersection[has_pred] / union[has_pred]
+    return ious
+
+
+def compute_mious(thresholds, cam_pkls, gt):
+    """
+    Given a list of thresholds and a list of heatmap pickle files, return the
+    mIoU at each threshold. Each heatmap is loaded and resized only once.
+
+    Args:
+        thresholds (list): the thresholds used to convert heatmaps to segmentations
         cam_pkls (list): a list of heatmap pickle files (for a given pathology)
         gt (dict): dictionary of ground truth segmentation masks
     """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
     ious = []
     for pkl_path in tqdm(cam_pkls):
-        # break down path to image name and task
-        path = str(pkl_path).split('/')
-        task = path[-1].split('_')[-2]
-        img_id = '_'.join(path[-1].split('_')[:-2])
+        task, img_id = parse_pkl_filename(pkl_path)
 
-        # add image and segmentation to submission dictionary
         if img_id in gt:
-            pred_mask = pkl_to_mask(pkl_path=pkl_path, threshold=threshold)
+            map_resized, _ = load_heatmap(pkl_path)
+            heatmap = normalize_heatmap(map_resized)
             gt_item = gt[img_id][task]
             gt_mask = mask.decode(gt_item)
-            assert (pred_mask.shape == gt_mask.shape)
-            iou_score = calculate_iou(pred_mask, gt_mask, true_pos_only=True)
+            assert (heatmap.shape == gt_mask.shape)
+            iou_scores = sweep_ious(heatmap, gt_mask, thresholds)
+        else:
+            iou_scores = np.full(len(thresholds), np.nan)
+        ious.append(iou_scores)
+
+    ious = np.array(ious).reshape(-1, len(thresholds))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mious = np.nanmean(ious, axis=0)
+    return mious
+
+
+def compute_miou(threshold, cam_pkls, gt):
+    """
+    Given a threshold and a list of heatmap pickle files, return the mIoU.
+
+    Args:
+        threshold (double): the threshold used to convert heatmaps to segmentations
+        cam_pkls (list): a list of heatmap pickle files (for a given pathology)
+        gt (dict): dictionary of ground truth segmentation masks
+    """
+    return compute_mious([threshold], cam_pkls, gt)[0]
+
+
+def heatmap_histogram(heatmap, gt_mask, num_bins):
+    """
+    Bin the pixels of a normalized heatmap into `num_bins` buckets, separately
+    for pixels inside and outside the ground truth. Bucket 0 holds values
+    <= 0 and bucket j holds values in ((j - 1) / num_bins, j / num_bins], so
+    the number of pixels above threshold j / num_bins is a suffix sum.
+
+    Args:
+        heatmap (np.ndarray): normalized [H x W] heatmap
+        gt_mask (np.ndarray): [H x W] binary ground-truth segmentation
+        num_bins (int): number of buckets over [0, 1]
+
+    Returns:
+        histogram (np.ndarray): [2 x (num_bins + 1)] pixel counts inside and
+                                outside the ground truth
+    """
+    gt_mask = gt_mask.astype(bool)
+    edges = np.arange(num_bins + 1) / num_bins
+    # NaN pixels (constant heatmaps) land in an extra bucket that is dropped,
+    # as they are never above a threshold
+    bins = np.searchsorted(edges, heatmap, side='left')
+    inside = np.bincount(bins[gt_mask], minlength=num_bins + 2)
+    outside = np.bincount(bins[~gt_mask], minlength=num_bins + 2)
+    return np.stack([inside[:num_bins + 1], outside[:num_bins + 1]])
+
+
+def compute_histograms(cam_pkls, gt, num_bins):
+    """
+    Compute the heatmap histogram of every pickle file with a ground truth.
+
+    Args:
+        cam_pkls (list): a list of heatmap pickle files (for a given pathology)
+        gt (dict): dictionary of ground truth segmentation masks
+        num_bins (int): number of buckets over [0, 1]
+
+    Returns:
+        img_ids (list): ids of the CXRs that have a ground truth
+        histograms (np.ndarray): [N x 2 x (num_bins + 1)] histograms
+    """
+    img_ids = []
+    histograms = []
+    for pkl_path in tqdm(cam_pkls):
+        task, img_id = parse_pkl_filename(pkl_path)
+        if img_id not in gt:
+            continue
+        map_resized, _ = load_heatmap(pkl_path)
+        heatmap = normalize_heatmap(map_resized)
+        gt_mask = mask.decode(gt[img_id][task])
+        assert (heatmap.shape == gt_mask.shape)
+        img_ids.append(img_id)
+        histograms.append(heatmap_histogram(heatmap, gt_mask, num_bins))
+
+    histograms = np.array(histograms, dtype=np.int64).reshape(-1, 2,
+                                                              num_bins + 1)
+    return img_ids, histograms
+
+
+def histogram_fingerprint(task, gt, num_bins):
+    """
+    Fingerprint of the inputs of `compute_histograms` other than heatmaps:
+    the ground truth of the pathology and the number of buckets. It does not
+    need the heatmaps, so saved histograms can be checked without them.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{num_bins};'.encode())
+    for img_id in sorted(gt):
+        gt_item = gt[img_id][task]
+        h, w = gt_item['size']
+        digest.update(f'{img_id}|{h},{w}:{gt_item["counts"]};'.encode())
+    return digest.hexdigest()
+
+
+def heatmaps_fingerprint(cam_pkls):
+    """
+    Fingerprint of the heatmaps of `compute_histograms` from the names, sizes
+    and modification times of their files, so checking it reads no heatmap.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for pkl_path in cam_pkls:
+        if isinstance(pkl_path, StoredHeatmap):
+            paths = [Path(pkl_path.store_dir) / name
+                     for name in ('index.csv', 'maps.bin')]
+            digest.update(f'{pkl_path}|{pkl_path.row}'.encode())
         else:
-            iou_score = np.nan
-        ious.append(iou_score)
+            paths = [Path(pkl_path)]
+            digest.update(f'{pkl_path}'.encode())
+        for path in paths:
+            stat = path.stat()
+            digest.update(f'|{stat.st_size},{stat.st_mtime_ns}'.encode())
+        digest.update(b';')
+    return digest.hexdigest()
+
+
+def save_histograms(path, img_ids, histograms, fingerprint='', heatmaps=''):
+    """
+    Save per-image histograms so thresholds can be re-tuned without pickles,
+    with the fingerprints of their inputs.
+    """
+    np.savez(path, img_ids=np.array(img_ids, dtype=str), histograms=histograms,
+             fingerprint=np.array(fingerprint), heatmaps=np.array(heatmaps))
+
+
+def load_histograms(path, fingerprint=None, heatmaps=None):
+    """
+    Load per-image histograms saved by `save_histograms`. If `fingerprint`
+    or `heatmaps` is given and differs from the saved one, return None.
+    """
+    with np.load(path) as data:
+        for name, expected in [('fingerprint', fingerprint),
+                               ('heatmaps', heatmaps)]:
+            if expected is not None and \
+                    (name not in data or str(data[name]) != expected):
+                return None
+        return data['img_ids'].tolist(), data['histograms']
+
+
+def miou_curve(histograms, thresholds=None):
+    """
+    Compute the exact mIoU (on the true positive slice) at every threshold of
+    the histogram grid, in O(num_bins) per image.
+
+    Args:
+        histograms (np.ndarray): [N x 2 x (num_bins + 1)] histograms
+        thresholds (np.ndarray): thresholds to evaluate; each must be a
+                                 multiple of 1 / num_bins. If None, use the
+                                 whole grid 0, 1 / num_bins, ..., 1.
+
+    Returns:
+        thresholds (np.ndarray): evaluated thresholds
+        mious (np.ndarray): mIoU at each threshold
+    """
+    num_bins = histograms.shape[-1] - 1
+    if thresholds is None:
+        idx = np.arange(num_bins + 1)
+        thresholds = idx / num_bins
+    else:
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        idx = grid_indices(thresholds, num_bins)
+
+    # number of pixels strictly above each grid threshold
+    suffix = np.cumsum(histograms[..., ::-1], axis=-1)[..., ::-1]
+    above = np.zeros_like(histograms)
+    above[..., :-1] = suffix[..., 1:]
+    above = above[..., idx]
+
+    intersection = above[:, 0]
+    pred_area = above[:, 0] + above[:, 1]
+    gt_area = histograms[:, 0].sum(axis=-1, keepdims=True)
+    union = pred_area + gt_area - intersection
+
+    ious = np.full(intersection.shape, np.nan)
+    valid = (pred_area > 0) & (gt_area > 0)
+    ious[valid] = intersection[valid] / union[valid]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mious = np.nanmean(ious, axis=0)
+    return thresholds, mious
+
+
+def get_task_histograms(task, gt, cam_dir, hist_dir, num_bins):
+    """
+    Load the histograms of a pathology, or compute and save them if they do
+    not exist yet or were computed from other heatmaps, ground truth or
+    number of buckets. Without heatmaps of the pathology in `cam_dir`, the
+    saved histograms are used as long as the ground truth and number of
+    buckets are unchanged.
+    """
+    hist_path = Path(hist_dir) / f'{task}_histograms.npz'
+    cam_pkls = [] if cam_dir is None else list_heatmaps(cam_dir, task)
+    cam_pkls = [pkl_path for pkl_path in cam_pkls
+                if parse_pkl_filename(pkl_path)[1] in gt]
+    fingerprint = histogram_fingerprint(task, gt, num_bins)
+
+    if not cam_pkls:
+        if not hist_path.exists():
+            raise FileNotFoundError(f'No heatmaps of {task} with a ground '
+                                    f'truth and no histograms {hist_path}')
+        saved = load_histograms(hist_path, fingerprint)
+        if saved is None:
+            raise ValueError(f'{hist_path} was computed with another ground '
+                             f'truth or number of buckets, and there are no '
+                             f'heatmaps to recompute it')
+        return saved
+
+    heatmaps = heatmaps_fingerprint(cam_pkls)
+    if hist_path.exists():
+        saved = load_histograms(hist_path, fingerprint, heatmaps)
+        if saved is not None:
+            return saved
+        print(f'Recomputing outdated histograms {hist_path}')
+
+    img_ids, histograms = compute_histograms(cam_pkls, gt, num_bins)
+    Path(hist_dir).mkdir(exist_ok=True, parents=True)
+    save_histograms(hist_path, img_ids, histograms, fingerprint, heatmaps)
+    return img_ids, histograms
+
+
+def grid_indices(thresholds, num_bins):
+    """
+    Return the histogram bucket of each threshold, raising a ValueError if a
+    threshold is not a multiple of 1 / `num_bins` in [0, 1].
+    """
+    if num_bins <= 0:
+        raise ValueError('`num_bins` must be positive')
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    idx = np.rint(thresholds * num_bins).astype(int)
+    if not (np.allclose(idx / num_bins, thresholds) and
+            np.all((idx >= 0) & (idx <= num_bins))):
+        raise ValueError(f'thresholds must be multiples of 1 / {num_bins} '
+                         f'in [0, 1] to lie on the histogram grid')
+    return idx
 
-    miou = np.nanmean(np.array(ious))
-    return miou
 
+def best_threshold(thresholds, mious):
+    """
+    Return the threshold with the highest mIoU, raising a ValueError if no
+    mIoU is defined (no CXR has both a segmentation and a ground truth).
+    """
+    mious = np.asarray(mious, dtype=np.float64)
+    if np.isnan(mious).all():
+        raise ValueError('mIoU is undefined at every threshold')
+    return thresholds[np.nanargmax(mious)]
 
-def tune_threshold(task, gt, cam_dir):
+
+def tune_threshold(task, gt, cam_dir, hist_dir=None, num_bins=100,
+                   thresholds=None):
     """
     For a given pathology, find the threshold that maximizes mIoU.
 
     Args:
         task (str): localization task
         gt (dict): dictionary of the ground truth segmentation masks
-        cam_dir (str): directory with pickle files containing heat maps
+        cam_dir (str): directory with pickle files containing heat maps, or
+                       heatmap store
+        hist_dir (str): if given, tune from per-image heatmap histograms
+                        saved in this directory, computing and saving them
+                        first if they do not exist yet or are outdated
+        num_bins (int): number of histogram buckets over [0, 1]
+        thresholds (list): candidate thresholds (`THRESHOLDS` if None); with
+                           `hist_dir`, multiples of 1 / `num_bins`
+    """
+    if thresholds is None:
+        thresholds = THRESHOLDS
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    if hist_dir is not None:
+        grid_indices(thresholds, num_bins)
+        _, histograms = get_task_histograms(task, gt, cam_dir, hist_dir,
+                                            num_bins)
+        mious = miou_curve(histograms, thresholds)[1]
+    else:
+        cam_pkls = list_heatmaps(cam_dir, task)
+        mious = compute_mious(thresholds, cam_pkls, gt)
+    return best_threshold(thresholds, mious)
+
+
+def _tune_task(job):
+    """
+    Tune the threshold of one pathology, with the ground truth of this
+    process. Returns the task, its best threshold and, with histograms, its
+    full mIoU curve.
     """
-    cam_pkls = sorted(list(Path(cam_dir).rglob(f"*{task}_map.pkl")))
-    thresholds = np.arange(0.2, .8, .1)
-    mious = [compute_miou(threshold, cam_pkls, gt) for threshold in thresholds]
-    best_threshold = thresholds[mious.index(max(mious))]
-    return best_threshold
+    task, gt_path, map_dir, hist_dir, num_bins, thresholds = job
+    print(f"Task: {task}")
+    gt = load_shared_segmentations(gt_path)
+    if hist_dir is None:
+        threshold = tune_threshold(task, gt, map_dir, thresholds=thresholds)
+        return task, threshold, None
+
+    # the full curve gives the mIoU of every candidate on the grid
+    thresholds = np.asarray(THRESHOLDS if thresholds is None else thresholds,
+                            dtype=np.float64)
+    idx = grid_indices(thresholds, num_bins)
+    _, histograms = get_task_histograms(task, gt, map_dir, hist_dir, num_bins)
+    grid, mious = miou_curve(histograms)
+    threshold = best_threshold(thresholds, mious[idx])
+    curve = pd.DataFrame({'threshold': grid,
+                          'mIoU': mious,
+                          'task': task})
+    return task, threshold, curve
+
+
+def main(args):
+    """
+    Tune the threshold of every pathology and save them to
+    `tuning_results.csv`. With `args.jobs` > 1, pathologies are tuned
+    concurrently in a process pool; each worker loads the ground truth once,
+    and results are merged in the order of the pathologies.
+    """
+    jobs = [(task, args.gt_path, args.map_dir, args.hist_dir, args.num_bins,
+             args.thresholds) for task in sorted(LOCALIZATION_TASKS)]
+    if args.jobs > 1:
+        # each worker gets one core
+        with Pool(min(args.jobs, len(jobs)), initializer=torch.set_num_threads,
+                  initargs=(1,)) as pool:
+            results = pool.map(_tune_task, jobs, chunksize=1)
+    else:
+        results = [_tune_task(job) for job in jobs]
+
+    # tune thresholds and save the best threshold for each pathology to a csv file
+    tuning_results = pd.DataFrame(columns=['threshold', 'task'])
+    curves = []
+    for task, threshold, curve in results:
+        # thresholds of a finer grid keep their digits
+        df = pd.DataFrame([[round(threshold, 6), task]],
+                          columns=['threshold', 'task'])
+        tuning_results = pd.concat([tuning_results, df], axis=0)
+        if curve is not None:
+            curves.append(curve)
+
+    tuning_results.to_csv(f'{args.save_dir}/tuning_results.csv', index=False)
+
+    # full curves; the best threshold of a pathology is its row with max mIoU
+    if curves:
+        pd.concat(curves, ignore_index=True).to_csv(
+            f'{args.save_dir}/tuning_curves.csv', index=False)
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--map_dir', type=str,
-                        help='directory with pickle files containing heat maps')
+                        help='directory with pickle files containing heat maps, \
+                              or heatmap store (see heatmap_store.py); may be \
+                              omitted with --hist_dir to tune from saved \
+                              histograms')
     parser.add_argument('--gt_path', type=str,
                         help='json file where ground-truth segmentations are \
-                              saved (encoded)')
+                              saved (encoded), \
+                              or segmentation container')
     parser.add_argument('--save_dir', type=str, default='.',
                         help='where to save the best thresholds tuned on the \
                               validation set')
+    parser.add_argument('--hist_dir', type=str,
+                        help='if given, tune from per-image heatmap histograms \
+                              saved in this directory (computed on the first \
+                              run) and also save the full mIoU-vs-threshold \
+                              curve of each pathology')
+    parser.add_argument('--num_bins', type=int, default=100,
+                        help='number of histogram buckets over [0, 1] used \
+                              with --hist_dir')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=None,
+                        help='candidate thresholds (default 0.2, 0.3, ..., \
+                              0.7); with --hist_dir, multiples of \
+                              1 / num_bins. Saved histograms are swept on \
+                              them without reading the heatmaps.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of pathologies tuned concurrently in a \
+                              process pool; 1 tunes them one by one in the \
+                              main process')
     args = parser.parse_args()
+    assert args.num_bins > 0, "`num_bins` must be positive"
 
-    with open(args.gt_path) as f:
-        gt = json.load(f)
-
-    # tune thresholds and save the best threshold for each pathology to a csv file
-    tuning_results = pd.DataFrame(columns=['threshold', 'task'])
-    for task in sorted(LOCALIZATION_TASKS):
-        print(f"Task: {task}")
-        threshold = tune_threshold(task, gt, args.map_dir)
-        df = pd.DataFrame([[round(threshold, 1), task]],
-                          columns=['threshold', 'task'])
-        tuning_results = pd.concat([tuning_results, df], axis=0)
-
-    tuning_results.to_csv(f'{args.save_dir}/tuning_results.csv', index=False)
+    main(args)
@@ -8,65 +8,96 @@ The probability threshold is determined per pathology by maximizing the
 mIoU on the validation set.
 """
 from argparse import ArgumentParser
-import glob
-import json
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
-from pathlib import Path
-import pickle
-from pycocotools import mask
 import torch
-import torch.nn.functional as F
 from tqdm import tqdm
 
-from eval import calculate_iou
-from eval_constants import CHEXPERT_TASKS, LOCALIZATION_TASKS
-from heatmap_to_segmentation import cam_to_segmentation
+from eval_constants import LOCALIZATION_TASKS
+from heatmap_store import list_heatmaps
+from heatmap_to_segmentation import encode_heatmap
+from segmentation_cache import SegmentationCache
+from segmentation_json import load_shared_segmentations
+from utils import parse_pkl_filename, rle_area, rle_intersection_area
 
 
-def compute_miou(cutoff, pkl_paths,gt):
-    """Caculate mIoU given a threshold and a list of pkl paths."""
-    ious = []
+def compute_iou_components(pkl_paths, gt, lazy=False, cache=None):
+    """
+    Segment every heatmap once and keep only what the IoU at any probability
+    cutoff depends on: the segmentation does not depend on the cutoff, only
+    whether it is kept does. If `lazy`, heatmaps are upsampled band by band
+    (see lazy_heatmap.py). Areas are computed from the encoded segmentations,
+    which are read from `cache` (a `SegmentationCache`) if given.
+
+    Returns:
+        pred_probs (np.ndarray): model probability of each heatmap, in
+                                 float32 like the model output
+        intersections (np.ndarray): pixels in both segmentation and ground truth
+        pred_areas (np.ndarray): pixels in the saliency segmentation
+        gt_areas (np.ndarray): pixels in the ground-truth segmentation
+    """
+    # Otsu's method without probability cutoff
+    params = {'threshold': np.nan, 'prob_cutoff': 0, 'smoothing': False,
+              'k': 0, 'lazy': lazy}
+
+    pred_probs, intersections, pred_areas, gt_areas = [], [], [], []
     for pkl_path in tqdm(pkl_paths):
         # get saliency segmentation
-        info = pickle.load(open(pkl_path, 'rb'))
-        img_dims = info['cxr_dims']
-        map_resized = F.interpolate(info['map'], size=(img_dims[1],img_dims[0]),
-                                    mode='bilinear', align_corners=False)
-        if torch.is_tensor(info['prob']) and info['prob'].size()[0] == 14:
-            prob_idx = CHEXPERT_TASKS.index(info['task'])
-            pred_prob = info['prob'][prob_idx]
-        else:
-            pred_prob = info['prob']
-
-        if pred_prob > cutoff:
-            segm = cam_to_segmentation(map_resized)
-            pred_mask = np.array(segm)
-        else:
-            pred_mask = np.zeros((img_dims[1],img_dims[0]))
+        pred = encode_heatmap(pkl_path, params, cache, reuse_buffer=True)
 
         # get gt segmentation
-        path = str(pkl_path).split('/')
-        task = path[-1].split('_')[-2]
-        img_id = '_'.join(path[-1].split('_')[:-2])
+        task, img_id = parse_pkl_filename(pkl_path)
+        intersection, gt_area = 0, 0
         if img_id in gt:
             gt_item = gt[img_id][task]
-            gt_mask = mask.decode(gt_item)
-        else:
-            gt_mask = np.zeros((img_dims[1],img_dims[0]))
+            gt_area = rle_area(gt_item)
+            if pred['area'] > 0 and gt_area > 0:
+                intersection = rle_intersection_area(pred['rle'], gt_item)
 
-        iou = calculate_iou(pred_mask, gt_mask, true_pos_only=False)
-        ious.append(iou)
+        pred_probs.append(pred['prob'])
+        intersections.append(intersection)
+        pred_areas.append(pred['area'])
+        gt_areas.append(gt_area)
 
-    miou = round(np.nanmean(np.array(ious)), 3)
+    return (np.array(pred_probs, dtype=np.float32),
+            np.array(intersections, dtype=np.int64),
+            np.array(pred_areas, dtype=np.int64),
+            np.array(gt_areas, dtype=np.int64))
+
+
+def cutoff_miou(cutoff, components):
+    """
+    Caculate mIoU given a threshold and the output of `compute_iou_components`.
+    Segmentations of CXRs with a probability not above the cutoff are all zeros.
+    """
+    pred_probs, intersections, pred_areas, gt_areas = components
+    # the probabilities are float32 tensors in the pickle files, so the
+    # cutoff is compared in float32 (a probability of float32(0.3) is not
+    # above a cutoff of 0.3)
+    kept = pred_probs > np.float32(cutoff)
+    intersections = np.where(kept, intersections, 0)
+    pred_areas = np.where(kept, pred_areas, 0)
+    unions = pred_areas + gt_areas - intersections
+
+    ious = np.full(len(unions), np.nan)
+    has_union = unions > 0
+    ious[has_union] = intersections[has_union] / unions[has_union]
+
+    miou = round(np.nanmean(ious), 3)
     return miou
 
 
-def find_threshold(task, gt_dict, cam_dir):
+def compute_miou(cutoff, pkl_paths,gt):
+    """Caculate mIoU given a threshold and a list of pkl paths."""
+    return cutoff_miou(cutoff, compute_iou_components(pkl_paths, gt))
+
+
+def find_threshold(task, gt_dict, cam_dir, lazy=False, cache=None):
     """
     For a given task, find the probability threshold with max mIoU on val set.
     """
-    cam_pkl = sorted(list(Path(cam_dir).rglob(f"*{task}_map.pkl")))
+    cam_pkl = list_heatmaps(cam_dir, task)
     cutoffs = np.arange(0,.9,.1)
     # We make this one exception for Lung Lesion. On the val set, using
     # threshold = 0 gives mIoU of 0.001, whereas other thresholds yield mIoU of
@@ -78,20 +109,45 @@ def find_threshold(task, gt_dict, cam_dir):
     if task == 'Lung Lesion':
         cutoffs = np.arange(0.1,.9,.1)
 
-    mious = [compute_miou(cutoff, cam_pkl, gt_dict) for cutoff in cutoffs]
+    components = compute_iou_components(cam_pkl, gt_dict, lazy, cache)
+    mious = [cutoff_miou(cutoff, components) for cutoff in cutoffs]
     cutoff = cutoffs[mious.index(max(mious))]
     print(f"cutoff: {cutoffs}; iou: {mious}")
     return cutoffs, mious
 
 
+def _find_task_threshold(job):
+    """Run `find_threshold` for one task with the ground truth of this process."""
+    task, gt_path, cam_dir, lazy, cache = job
+    print(f"Task: {task}")
+    return find_threshold(task, load_shared_segmentations(gt_path), cam_dir,
+                          lazy, cache)
+
+
 def main(args):
-    with open(args.gt_path) as f:
-        gt_dict = json.load(f)
+    """
+    Tune the probability cutoff of every pathology and save the mIoU of each
+    cutoff to `probability_tuning_results.csv`. With `args.jobs` > 1,
+    pathologies are tuned concurrently in a process pool; each worker loads
+    the ground truth once, and results are merged in the order of the
+    pathologies.
+    """
+    tasks = sorted(LOCALIZATION_TASKS)
+    cache = None
+    if args.cache_dir:
+        cache = SegmentationCache(args.cache_dir, args.cache_size_mb << 20)
+    jobs = [(task, args.gt_path, args.map_dir, eval(args.lazy_upsampling),
+             cache) for task in tasks]
+    if args.jobs > 1:
+        # each worker gets one core
+        with Pool(min(args.jobs, len(jobs)), initializer=torch.set_num_threads,
+                  initargs=(1,)) as pool:
+            results = pool.map(_find_task_threshold, jobs, chunksize=1)
+    else:
+        results = [_find_task_threshold(job) for job in jobs]
 
     tuning_results = pd.DataFrame(columns=['prob_threshold','mIoU','task'])
-    for task in sorted(LOCALIZATION_TASKS):
-        print(f"Task: {task}")
-        cutoff, miou = find_threshold(task, gt_dict, args.map_dir)
+    for task, (cutoff, miou) in zip(tasks, results):
         df = pd.concat([pd.DataFrame([[round(cutoff[i], 1),
                                        round(miou[i], 3),
                                        task]],
@@ -108,12 +164,32 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--map_dir', type=str,
                         help='directory with pickle files containing heatmaps \
-                              and model output')
+                              and model output, or heatmap store (see \
+                              heatmap_store.py)')
     parser.add_argument('--gt_path', type=str,
                         help='json file where ground-truth segmentations are \
-                              saved (encoded)')
+                              saved (encoded), \
+                              or segmentation container')
     parser.add_argument('--save_dir', type=str, default='.',
                         help='where to save the probability threshold tuned on the \
                               validation set')
+    parser.add_argument('--lazy_upsampling', type=str, default='False',
+                        help='If true, upsample each heatmap band by band at \
+                              its native resolution instead of materializing \
+                              it at full CXR size, to reduce peak memory.')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='directory of a cache of derived segmentations \
+                              (see segmentation_cache.py), shared with \
+                              heatmap_to_segmentation.py')
+    parser.add_argument('--cache_size_mb', type=int, default=1024,
+                        help='maximum size of the cache (MB) before least \
+                              recently used segmentations are evicted')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of pathologies tuned concurrently in a \
+                              process pool; 1 tunes them one by one in the \
+                              main process')
     args = parser.parse_args()
+    assert args.lazy_upsampling in ['True', 'False'], \
+        "`lazy_upsampling` flag must be either `True` or `False`"
+
     main(args)
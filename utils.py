@@ -1,3 +1,4 @@
+from functools import lru_cache
 import io
 import math
 import numpy as np
@@ -32,12 +33,133 @@ def encode_segmentation(segmentation_arr):
     Returns:
 		Rs (dict): the encoded mask in RLE format
     """
-    segmentation = np.asfortranarray(segmentation_arr.astype('uint8'))
+    segmentation = np.asfortranarray(segmentation_arr.astype('uint8',
+                                                            copy=False))
     Rs = mask.encode(segmentation)
     Rs['counts'] = Rs['counts'].decode()
     return Rs
 
 
+def empty_segmentation(h, w):
+    """
+    Return the RLE of an all-zero [h x w] segmentation, as
+    `encode_segmentation` would, without creating the array.
+    """
+    return {'size': [h, w], 'counts': _empty_counts(h * w)}
+
+
+@lru_cache(maxsize=None)
+def _empty_counts(num_pixels):
+    return rle_counts_to_string([num_pixels])
+
+
+def rle_counts_to_string(counts):
+    """
+    Compress run lengths to the string format of the Mask API (the inverse of
+    `rle_counts`).
+    """
+    chars = []
+    for i, x in enumerate(counts):
+        x = int(x)
+        if i > 2:
+            x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return ''.join(chars)
+
+
+def rle_counts(rle):
+    """
+    Return the run lengths of an RLE, alternating background and foreground
+    and starting with background, in column-major pixel order.
+
+    Args:
+        rle (dict): encoded mask with compressed (str or bytes) or
+                    uncompressed (list) counts
+    Returns:
+        counts (np.ndarray): run lengths
+    """
+    counts = rle['counts']
+    if isinstance(counts, list):
+        return np.asarray(counts, dtype=np.int64)
+    if isinstance(counts, str):
+        counts = counts.encode()
+
+    # inverse of the LEB128-like string compression of the Mask API:
+    # 5 bits per char, 0x20 flags more chars, 0x10 of the last one is the
+    # sign, and runs from the third on are stored as differences
+    runs = []
+    p = 0
+    while p < len(counts):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = counts[p] - 48
+            x |= (c & 0x1f) << 5 * k
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << 5 * k
+        if len(runs) > 2:
+            x += runs[-2]
+        runs.append(x)
+    return np.asarray(runs, dtype=np.int64)
+
+
+def rle_area(rle):
+    """Return the number of foreground pixels of an encoded mask."""
+    if isinstance(rle['counts'], list):
+        return int(rle_counts(rle)[1::2].sum())
+    return int(mask.area(rle))
+
+
+def rle_is_empty(rle):
+    """Return True if an encoded mask has no foreground pixels."""
+    return rle_area(rle) == 0
+
+
+def rle_intersection_area(rle_a, rle_b):
+    """Return the number of pixels in the foreground of both encoded masks."""
+    return int(mask.area(mask.merge([rle_a, rle_b], intersect=True)))
+
+
+def rle_contains(rle, rows, cols):
+    """
+    Look up pixels in an encoded mask without decoding it, by binary search
+    over the cumulative run lengths. Indices follow numpy indexing of the
+    decoded mask: negative indices count from the end, and out of range
+    indices raise an IndexError.
+
+    Args:
+        rle (dict): encoded mask
+        rows (int or array-like): rows of the pixels
+        cols (int or array-like): columns of the pixels
+    Returns:
+        hits (bool or np.ndarray): True where a pixel is foreground
+    """
+    h, w = rle['size']
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    for idx, size in ((rows, h), (cols, w)):
+        if np.any((idx < -size) | (idx >= size)):
+            raise IndexError(f'index out of bounds for size {size}')
+    rows = rows % h
+    cols = cols % w
+
+    ends = np.cumsum(rle_counts(rle))
+    runs = np.searchsorted(ends, cols * h + rows, side='right')
+    hits = runs % 2 == 1
+    return bool(hits) if hits.ndim == 0 else hits
+
+
 def run_linear_regression(regression_df, task, y, x):
     """
     Run linear regression model given a regression dataframe of a single pathology.